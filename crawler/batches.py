@@ -0,0 +1,103 @@
+"""
+Request bodies for submitting crawl results to the coordinator.
+
+The JSON is encoded one item at a time and compressed as it is produced, so a
+batch is never held in memory as one uncompressed string. By default the body
+is plain JSON sent with a Content-Length, which any server understands.
+Compression and streaming the body with chunked transfer encoding are opt-in,
+for servers known to decode them.
+"""
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+DEFAULT_COMPRESSION = 'none'
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Amount of JSON text to collect before passing it to the compressor
+ENCODE_CHUNK_SIZE = 64 * 1024
+
+
+def _new_compressor(compression: str):
+    if compression == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if compression == 'none':
+        return None
+    raise ValueError(f"Unknown compression {compression}")
+
+
+class BatchBody:
+    """
+    An iterable request body holding the JSON batch of a user's crawl results,
+    compressed with `compression`. `requests` streams an iterable body with
+    chunked transfer encoding, use `encode()` to send it with a Content-Length
+    instead. Once it has been sent, `raw_size` and `wire_size` are the number
+    of bytes of JSON and of the (compressed) body.
+    """
+
+    def __init__(self, user_id: str, items: list, compression: str = DEFAULT_COMPRESSION):
+        self.user_id = user_id
+        self.items = items
+        self.compression = compression
+        self.raw_size = 0
+        self.wire_size = 0
+        # Fail now rather than part way through sending the request
+        _new_compressor(compression)
+
+    @property
+    def headers(self) -> dict:
+        headers = {'Content-Type': 'application/json'}
+        if self.compression != 'none':
+            headers['Content-Encoding'] = self.compression
+        return headers
+
+    def __iter__(self):
+        self.raw_size = self.wire_size = 0
+        compressor = _new_compressor(self.compression)
+        parts = []
+        size = 0
+        for part in self._json_parts():
+            parts.append(part)
+            size += len(part)
+            if size >= ENCODE_CHUNK_SIZE:
+                yield from self._encode(compressor, ''.join(parts))
+                parts = []
+                size = 0
+        yield from self._encode(compressor, ''.join(parts), last=True)
+
+    def encode(self) -> bytes:
+        """The whole body at once."""
+        return b''.join(self)
+
+    def _json_parts(self):
+        """The same JSON as `json.dumps({'user_id': ..., 'items': ...})`, in pieces."""
+        yield '{"user_id": ' + json.dumps(self.user_id) + ', "items": ['
+        for i, item in enumerate(self.items):
+            yield (', ' if i else '') + json.dumps(item)
+        yield ']}'
+
+    def _encode(self, compressor, text: str, last: bool = False):
+        data = text.encode('utf8')
+        self.raw_size += len(data)
+        if compressor is not None:
+            data = compressor.compress(data)
+            if last:
+                data += compressor.flush()
+        # An empty chunk would end a chunked body
+        if data:
+            self.wire_size += len(data)
+            yield data
+
+
+def compression_available(compression: str) -> bool:
+    return compression != 'zstd' or zstandard is not None
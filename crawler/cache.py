@@ -0,0 +1,68 @@
+"""
+A bounded in-memory cache whose entries expire, shared by the DNS and robots.txt
+caches.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+# Returned by `TtlLruCache.get` and `peek` when there is no unexpired entry, since None may be a cached value
+MISSING = object()
+
+
+class TtlLruCache:
+    """
+    A thread-safe LRU cache of at most `max_size` entries, each of which expires
+    after the TTL it was stored with. Hits are counted by `get`, and misses by
+    `record_miss`, so that callers can count a miss once however many of them
+    wait for the same value to be loaded.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Returns the unexpired value for `key`, counting a hit, or MISSING."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return MISSING
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """Returns the unexpired value for `key`, or MISSING, without counting a hit or refreshing it."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return MISSING
+        return entry[0]
+
+    def put(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record_miss(self):
+        with self._lock:
+            self._misses += 1
+
+    def pop_stats(self):
+        """Return the hit and miss counts since the last call and reset them."""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+            self._hits = self._misses = 0
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / total if total else 0.0,
+        }
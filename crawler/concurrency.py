@@ -0,0 +1,148 @@
+"""
+Choose how many URLs to crawl at once from how the crawl is going.
+
+The right number depends on the hosts in a batch, network latency and how much
+CPU is left for parsing, all of which change over time. The controller grows the
+limit by one after each window of URLs that went well, and cuts it by a fraction
+when latency, errors or CPU use suggest the crawler is overloaded.
+"""
+import os
+import statistics
+import threading
+import time
+from logging import getLogger
+from typing import Optional
+
+
+# Number of completed URLs to look at before each adjustment, if the limit is smaller
+MIN_WINDOW = 10
+BACKOFF_RATIO = 0.75
+# Back off when the median latency in a window is this many times the lowest seen
+LATENCY_TOLERANCE = 2.0
+# The lowest latency seen is raised by this fraction each window, so it follows slow changes
+BASE_LATENCY_DRIFT = 0.02
+# Back off when the error rate in a window is this much higher than its moving average
+ERROR_RATE_TOLERANCE = 0.2
+ERROR_RATE_SMOOTHING = 0.1
+# Back off when the process uses more than this fraction of the CPU time of the cores it can run on
+DEFAULT_MAX_CPU = 0.9
+
+
+logger = getLogger(__name__)
+
+
+def available_cores() -> int:
+    """The number of cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ConcurrencyController:
+    """
+    An additive increase, multiplicative decrease controller of the number of
+    URLs in flight, between `min_limit` and `max_limit`. Callers keep at most
+    `limit` URLs in flight and `record` the latency of each one that finishes
+    and whether it failed. If the bounds are equal the limit is fixed.
+
+    CPU use is measured per available core. The CPU time of the thread that
+    calls `record`, which runs the crawl loop, is left out, so the controller
+    doesn't react to the overhead of scheduling URLs.
+    """
+
+    def __init__(self, min_limit: int, max_limit: int, initial: Optional[int] = None,
+                 max_cpu: float = DEFAULT_MAX_CPU):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError(f"Invalid concurrency bounds {min_limit} to {max_limit}")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_cpu = max_cpu
+        self.cores = available_cores()
+        self._limit = min(max(initial if initial is not None else min_limit, min_limit), max_limit)
+        self._lock = threading.Lock()
+        self._base_latency = None
+        self._error_rate = None
+        self._start_window()
+        self._batch_latencies = []
+        self._batch_errors = 0
+        self._batch_increases = 0
+        self._batch_decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def fixed(self) -> bool:
+        return self.min_limit == self.max_limit
+
+    def _start_window(self):
+        self._latencies = []
+        self._errors = 0
+        self._window_start = time.monotonic()
+        self._window_cpu_start = time.process_time()
+        self._window_thread = threading.get_ident()
+        self._window_thread_cpu_start = time.thread_time()
+
+    def record(self, latency: float, error: bool):
+        """Record a URL that took `latency` seconds to crawl."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._errors += error
+            self._batch_latencies.append(latency)
+            self._batch_errors += error
+            if len(self._latencies) >= max(self._limit, MIN_WINDOW):
+                self._adjust()
+                self._start_window()
+
+    def _adjust(self):
+        """Update the limit at the end of a window. Must be called with the lock held."""
+        latency = statistics.median(self._latencies)
+        error_rate = self._errors / len(self._latencies)
+        elapsed = time.monotonic() - self._window_start
+        cpu_time = time.process_time() - self._window_cpu_start
+        if threading.get_ident() == self._window_thread:
+            cpu_time -= time.thread_time() - self._window_thread_cpu_start
+        cpu = max(cpu_time, 0.0) / (elapsed * self.cores) if elapsed > 0 else 0.0
+
+        if self._base_latency is None:
+            self._base_latency = latency
+        else:
+            self._base_latency = min(self._base_latency * (1 + BASE_LATENCY_DRIFT), latency)
+        if self._error_rate is None:
+            self._error_rate = error_rate
+
+        overloaded = (latency > self._base_latency * LATENCY_TOLERANCE
+                      or error_rate > self._error_rate + ERROR_RATE_TOLERANCE
+                      or cpu > self.max_cpu)
+        self._error_rate += ERROR_RATE_SMOOTHING * (error_rate - self._error_rate)
+        if self.fixed:
+            return
+
+        if overloaded:
+            new_limit = max(int(self._limit * BACKOFF_RATIO), self.min_limit)
+            self._batch_decreases += new_limit < self._limit
+        else:
+            new_limit = min(self._limit + 1, self.max_limit)
+            self._batch_increases += new_limit > self._limit
+        if new_limit != self._limit:
+            logger.debug(f"Concurrency limit {self._limit} -> {new_limit}: median latency {latency:.2f}s "
+                         f"(base {self._base_latency:.2f}s), error rate {error_rate:.2f}, CPU {cpu:.2f}")
+        self._limit = new_limit
+
+    def pop_stats(self):
+        """Return the limit and what was recorded since the last call, and reset the counts."""
+        with self._lock:
+            latencies, errors = self._batch_latencies, self._batch_errors
+            increases, decreases = self._batch_increases, self._batch_decreases
+            self._batch_latencies = []
+            self._batch_errors = self._batch_increases = self._batch_decreases = 0
+            limit = self._limit
+        return {
+            'limit': limit,
+            'increases': increases,
+            'decreases': decreases,
+            'median_latency': round(statistics.median(latencies), 3) if latencies else 0.0,
+            'error_rate': round(errors / len(latencies), 3) if latencies else 0.0,
+        }
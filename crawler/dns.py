@@ -0,0 +1,146 @@
+"""
+In-process DNS cache used by the crawler's HTTP connections, so that the
+robots.txt and page requests to a host only resolve it once.
+"""
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from urllib.parse import urlparse
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util.connection import _set_socket_options, allowed_gai_family
+from urllib3.util.timeout import _DEFAULT_TIMEOUT
+
+from crawler.cache import MISSING, TtlLruCache
+
+
+DEFAULT_MAX_SIZE = 10000
+# getaddrinfo doesn't tell us the record's TTL, so use a fixed one
+DEFAULT_TTL_SECONDS = 5 * 60
+DEFAULT_NEGATIVE_TTL_SECONDS = 60
+NUM_PREFETCH_THREADS = 8
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+logger = getLogger(__name__)
+
+
+class DnsCache:
+    """
+    A bounded, thread-safe LRU cache of getaddrinfo results. Failed lookups are
+    cached for a shorter time and raise a new error with the original's
+    arguments, so the cached one doesn't collect a traceback each time.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL_SECONDS,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL_SECONDS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TtlLruCache(max_size)
+        self._prefetch_executor = None
+
+    def getaddrinfo(self, host: str, port: int, family: int = 0):
+        key = (host, port, family)
+        result = self._cache.get(key)
+        if result is MISSING:
+            self._cache.record_miss()
+            try:
+                result = (socket.getaddrinfo(host, port, family, socket.SOCK_STREAM), None)
+                ttl = self.ttl
+            except socket.gaierror as e:
+                result = (None, e.args)
+                ttl = self.negative_ttl
+            self._cache.put(key, result, ttl)
+
+        addresses, error_args = result
+        if error_args is not None:
+            raise socket.gaierror(*error_args)
+        return addresses
+
+    def prefetch(self, urls):
+        """Resolve the hosts of the given URLs in the background."""
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(NUM_PREFETCH_THREADS, thread_name_prefix='dns')
+
+        addresses = set()
+        for url in urls:
+            try:
+                parsed_url = urlparse(url)
+                port = parsed_url.port or DEFAULT_PORTS.get(parsed_url.scheme)
+            except ValueError:
+                continue
+            if parsed_url.hostname and port:
+                addresses.add((parsed_url.hostname, port))
+
+        family = allowed_gai_family()
+        for host, port in addresses:
+            self._prefetch_executor.submit(self._prefetch_address, host, port, family)
+
+    def _prefetch_address(self, host, port, family):
+        try:
+            self.getaddrinfo(host, port, family)
+        except (OSError, UnicodeError) as e:
+            logger.debug(f"Unable to resolve {host}: {e}")
+
+    def pop_stats(self):
+        """Return the hit and miss counts since the last call and reset them."""
+        return self._cache.pop_stats()
+
+
+def create_connection(dns_cache: DnsCache, address, timeout=_DEFAULT_TIMEOUT, source_address=None,
+                      socket_options=None) -> socket.socket:
+    """The same as `urllib3.util.connection.create_connection`, but resolving the host through the cache."""
+    host, port = address
+    if host.startswith("["):
+        host = host.strip("[]")
+
+    err = None
+    for af, socktype, proto, canonname, sa in dns_cache.getaddrinfo(host, port, allowed_gai_family()):
+        sock = None
+        try:
+            sock = socket.socket(af, socktype, proto)
+            _set_socket_options(sock, socket_options)
+            if timeout is not _DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except OSError as e:
+            err = e
+            if sock is not None:
+                sock.close()
+
+    if err is not None:
+        raise err
+    raise OSError("getaddrinfo returns an empty list")
+
+
+def _caching_connection_class(base, dns_cache: DnsCache):
+    class CachingConnection(base):
+        def _new_conn(self):
+            # Mirrors urllib3's HTTPConnection._new_conn so that errors are reported the same way
+            try:
+                sock = create_connection(dns_cache, (self._dns_host, self.port), self.timeout,
+                                         source_address=self.source_address, socket_options=self.socket_options)
+            except socket.gaierror as e:
+                raise NameResolutionError(self.host, self, e) from e
+            except socket.timeout as e:
+                raise ConnectTimeoutError(
+                    self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from e
+            except OSError as e:
+                raise NewConnectionError(self, f"Failed to establish a new connection: {e}") from e
+
+            sys.audit("http.client.connect", self, self.host, self.port)
+            return sock
+
+    CachingConnection.__name__ = CachingConnection.__qualname__ = base.__name__
+    return CachingConnection
+
+
+def caching_connection_classes(dns_cache: DnsCache):
+    """HTTP and HTTPS connection classes that resolve hosts through `dns_cache`."""
+    return (_caching_connection_class(HTTPConnection, dns_cache),
+            _caching_connection_class(HTTPSConnection, dns_cache))
@@ -0,0 +1,84 @@
+"""
+Turn the hrefs found on a page into the absolute URLs, without fragments,
+that are sent back to the coordinator. The same links appear on many pages
+of a site, so results are memoized for the whole process.
+"""
+import re
+from functools import lru_cache
+from logging import getLogger
+from typing import Optional
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+
+MAX_URL_LENGTH = 150
+BAD_URL_REGEX = re.compile(r'\/\/localhost\b|\.jpg$|\.png$|\.js$|\.gz$|\.zip$|\.pdf$|\.bz2$|\.ipynb$|\.py$')
+# The schemes starting with "http" for which urlparse splits off ;parameters
+PARAMS_SCHEMES = {'http', 'https'}
+LINK_CACHE_SIZE = 100000
+BASE_URL_CACHE_SIZE = 1000
+
+
+logger = getLogger(__name__)
+
+
+def _strip_params(path: str) -> str:
+    """Remove the ;parameters of the last path segment, as `urlparse` does."""
+    i = path.find(';', path.rfind('/') + 1)
+    return path if i < 0 else path[:i]
+
+
+@lru_cache(maxsize=LINK_CACHE_SIZE)
+def normalize_absolute_link(link: str) -> Optional[str]:
+    """
+    Returns an absolute link without its fragment, or None if it is too long,
+    not HTTP or points at something we don't crawl.
+    """
+    if not link.startswith('http') or len(link) > MAX_URL_LENGTH:
+        return None
+
+    if BAD_URL_REGEX.search(link):
+        logger.debug("Found bad URL: %s", link)
+        return None
+
+    try:
+        parsed_url = urlsplit(link)
+    except ValueError:
+        logger.info("Unable to parse link %s", link)
+        return None
+
+    path = parsed_url.path
+    if ';' in path and parsed_url.scheme in PARAMS_SCHEMES:
+        path = _strip_params(path)
+    return urlunsplit((parsed_url.scheme, parsed_url.netloc, path, parsed_url.query, ''))
+
+
+@lru_cache(maxsize=BASE_URL_CACHE_SIZE)
+def get_base_url(url: str) -> str:
+    """The scheme and host of a URL, which root-relative links are resolved against."""
+    parsed_url = urlsplit(url)
+    return urlunsplit((parsed_url.scheme, parsed_url.netloc, "", "", ""))
+
+
+@lru_cache(maxsize=LINK_CACHE_SIZE)
+def normalize_link(link: str, current_url: str) -> Optional[str]:
+    """
+    Resolve a link found on the page at `current_url` and normalize it with
+    `normalize_absolute_link`. Returns None for links we don't crawl.
+    """
+    if link.startswith("http"):
+        return normalize_absolute_link(link)
+
+    if "://" in link:
+        logger.debug("Bad URL: %s", link)
+        return None
+
+    # Relative link
+    if link.startswith("/"):
+        base_url = get_base_url(current_url)
+        # urljoin would only prepend the base, unless the link is protocol-relative,
+        # has empty or dot segments to remove or has characters urljoin strips
+        if link[1:2] != "/" and "//" not in link and "/." not in link and link.isprintable():
+            return normalize_absolute_link(base_url + link)
+        return normalize_absolute_link(urljoin(base_url, link))
+
+    return normalize_absolute_link(urljoin(current_url, link))
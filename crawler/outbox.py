@@ -0,0 +1,243 @@
+"""
+A durable queue of crawl results waiting to be sent to the coordinator.
+
+Results are written to a SQLite database next to the user data as each URL is
+crawled, and only deleted once the coordinator has accepted them. A batch is
+opened before its URLs are crawled and closed once they are done, and only
+closed batches are sent. A background thread sends them oldest first, backing
+off while the coordinator is unavailable, and sends anything left over from a
+previous run when the crawler starts, including the results of batches that
+were still being crawled.
+"""
+import json
+import random
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Optional
+
+
+INITIAL_RETRY_SECONDS = 1
+MAX_RETRY_SECONDS = 5 * 60
+# Number of times the coordinator may fail to accept a batch before it is moved aside
+MAX_ATTEMPTS = 20
+# Number of batches moved aside to keep, the oldest are deleted first
+MAX_FAILED_BATCHES = 1000
+# How long to wait for another connection to release a lock on the database
+STORE_TIMEOUT_SECONDS = 5
+
+
+logger = getLogger(__name__)
+
+
+class RejectedBatch(Exception):
+    """The coordinator refused a batch, so sending it again would not help."""
+
+
+class Outbox:
+    """
+    SQLite tables of batches of crawl results. `open_batch`, `add` and
+    `close_batch` build up a batch one result at a time. Closed batches are
+    returned in the order they were closed. Batches the coordinator rejected,
+    or failed to accept too many times, are moved to the `failed` table.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._added = threading.Condition()
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS batches
+                (id INTEGER PRIMARY KEY AUTOINCREMENT, items TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)
+            ''')
+            conn.execute('CREATE TABLE IF NOT EXISTS open_batches (id INTEGER PRIMARY KEY AUTOINCREMENT)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS results
+                (id INTEGER PRIMARY KEY AUTOINCREMENT, batch INTEGER NOT NULL, item TEXT NOT NULL)
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_batch ON results (batch)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS failed
+                (id INTEGER PRIMARY KEY AUTOINCREMENT, items TEXT NOT NULL, error TEXT, failed REAL NOT NULL)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+        # Whatever a previous run crawled of the batches it didn't finish is sent as it is
+        for batch_id in self._open_batch_ids():
+            self.close_batch(batch_id)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=STORE_TIMEOUT_SECONDS)
+        # With WAL, a commit survives the process crashing without waiting for a sync to disk
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _open_batch_ids(self) -> list:
+        conn = self._connect()
+        try:
+            return [row[0] for row in conn.execute('SELECT id FROM open_batches ORDER BY id')]
+        finally:
+            conn.close()
+
+    def open_batch(self) -> int:
+        """Start a batch of results and return its ID."""
+        conn = self._connect()
+        try:
+            cursor = conn.execute('INSERT INTO open_batches DEFAULT VALUES')
+            conn.commit()
+        finally:
+            conn.close()
+        return cursor.lastrowid
+
+    def add(self, batch_id: int, item: dict):
+        """Store one result of an open batch."""
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO results (batch, item) VALUES (?, ?)', (batch_id, json.dumps(item)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def close_batch(self, batch_id: int):
+        """Queue the results of an open batch to be sent, unless there are none."""
+        conn = self._connect()
+        try:
+            with conn:
+                items = [row[0] for row in conn.execute('SELECT item FROM results WHERE batch = ? ORDER BY id',
+                                                        (batch_id,))]
+                if items:
+                    conn.execute('INSERT INTO batches (items) VALUES (?)', ('[' + ', '.join(items) + ']',))
+                conn.execute('DELETE FROM results WHERE batch = ?', (batch_id,))
+                conn.execute('DELETE FROM open_batches WHERE id = ?', (batch_id,))
+        finally:
+            conn.close()
+        if items:
+            with self._added:
+                self._added.notify_all()
+
+    def peek(self):
+        """Returns the ID and items of the oldest batch, or None if the outbox is empty."""
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT id, items FROM batches ORDER BY id LIMIT 1').fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        batch_id, items = row
+        return batch_id, json.loads(items)
+
+    def remove(self, batch_id: int):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record_attempt(self, batch_id: int) -> int:
+        """Count a failed attempt to send a batch, and return the number so far."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('UPDATE batches SET attempts = attempts + 1 WHERE id = ?', (batch_id,))
+                row = conn.execute('SELECT attempts FROM batches WHERE id = ?', (batch_id,)).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row is not None else 0
+
+    def move_aside(self, batch_id: int, error: str):
+        """Move a batch that can't be sent to the `failed` table, keeping only the most recent ones there."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT INTO failed (items, error, failed) SELECT items, ?, ? FROM batches WHERE id = ?',
+                             (error, time.time(), batch_id))
+                conn.execute('DELETE FROM batches WHERE id = ?', (batch_id,))
+                conn.execute('DELETE FROM failed WHERE id <= (SELECT MAX(id) FROM failed) - ?', (MAX_FAILED_BATCHES,))
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM batches').fetchone()[0]
+        finally:
+            conn.close()
+
+    def wait(self, timeout: Optional[float] = None):
+        """Block until a batch is closed or the timeout expires."""
+        with self._added:
+            self._added.wait(timeout)
+
+
+class OutboxSender:
+    """
+    A daemon thread that sends the batches in an outbox with `send(items)`,
+    removing each one once `send` returns. If `send` raises `RejectedBatch`
+    the batch is moved aside, and on any other exception it is retried with
+    exponential backoff. An `OSError`, such as a `requests` connection error,
+    means the coordinator couldn't be reached, and is retried indefinitely.
+    Otherwise the coordinator answered but failed to accept the batch, and
+    after MAX_ATTEMPTS of those the batch is moved aside so it doesn't hold
+    up the ones after it.
+    """
+
+    def __init__(self, outbox: Outbox, send: Callable[[list], None]):
+        self.outbox = outbox
+        self.send = send
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+
+    def start(self):
+        backlog = len(self.outbox)
+        if backlog > 0:
+            logger.info(f"Sending {backlog} batches left in the outbox")
+        self._thread.start()
+
+    def _run(self):
+        delay = INITIAL_RETRY_SECONDS
+        while True:
+            batch = self.outbox.peek()
+            if batch is None:
+                # A batch can be closed between the peek and the wait, so look again from time to time
+                self.outbox.wait(timeout=INITIAL_RETRY_SECONDS)
+                continue
+
+            batch_id, items = batch
+            try:
+                self.send(items)
+            except RejectedBatch as e:
+                logger.exception(f"Moving rejected batch {batch_id} of {len(items)} items aside")
+                self.outbox.move_aside(batch_id, str(e))
+                continue
+            except OSError:
+                logger.exception(f"Exception sending batch {batch_id}, retrying in {delay:.0f} seconds")
+                delay = self._back_off(delay)
+                continue
+            except Exception as e:
+                attempts = self.outbox.record_attempt(batch_id)
+                if attempts < MAX_ATTEMPTS:
+                    logger.exception(f"Exception sending batch {batch_id}, attempt {attempts} of {MAX_ATTEMPTS}, "
+                                     f"retrying in {delay:.0f} seconds")
+                    delay = self._back_off(delay)
+                    continue
+                logger.exception(f"Moving batch {batch_id} of {len(items)} items aside after {attempts} attempts")
+                self.outbox.move_aside(batch_id, str(e))
+                continue
+
+            self.outbox.remove(batch_id)
+            delay = INITIAL_RETRY_SECONDS
+
+    @staticmethod
+    def _back_off(delay: float) -> float:
+        """Sleep for about `delay` seconds and return the next delay."""
+        time.sleep(delay * random.uniform(0.8, 1.2))
+        return min(delay * 2, MAX_RETRY_SECONDS)
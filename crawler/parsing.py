@@ -0,0 +1,78 @@
+"""
+Parse fetched pages in a pool of processes, so that parsing isn't limited by
+the GIL. Page bodies are handed to the workers through shared memory rather
+than being pickled.
+
+The workers are started from a fork server rather than forked from the crawler
+itself, which by then has crawl, sender and metrics threads whose locks a forked
+child could inherit while they are held.
+"""
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import Any, Callable, Optional
+
+
+ParseFunction = Callable[[str, Optional[int], bytes, int, Optional[str]], Any]
+
+
+def _parse_shared(parse: ParseFunction, shm_name: str, size: int, url: str, status_code: Optional[int],
+                  js_timestamp: int, charset: Optional[str]):
+    shm = SharedMemory(name=shm_name)
+    try:
+        content = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+    return parse(url, status_code, content, js_timestamp, charset)
+
+
+def _release(shm: SharedMemory):
+    shm.close()
+    shm.unlink()
+
+
+class ParserPool:
+    def __init__(self, num_processes: Optional[int] = None):
+        self.num_processes = num_processes
+        self._lock = Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.num_processes, mp_context=multiprocessing.get_context('forkserver'))
+
+    def submit(self, parse: ParseFunction, url: str, status_code: Optional[int], content: bytes,
+               js_timestamp: int, charset: Optional[str] = None) -> Future:
+        """
+        Call `parse(url, status_code, content, js_timestamp, charset)` in a worker process.
+        `parse` must be a module level function so that it can be pickled.
+        """
+        if len(content) == 0:
+            return self._submit(parse, url, status_code, content, js_timestamp, charset)
+
+        shm = SharedMemory(create=True, size=len(content))
+        try:
+            shm.buf[:len(content)] = content
+            future = self._submit(_parse_shared, parse, shm.name, len(content), url, status_code, js_timestamp,
+                                  charset)
+        except BaseException:
+            _release(shm)
+            raise
+        future.add_done_callback(lambda _: _release(shm))
+        return future
+
+    def _submit(self, *args) -> Future:
+        executor = self._executor
+        try:
+            return executor.submit(*args)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for running out of memory. Start a new pool and try once more.
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+                executor = self._executor
+            return executor.submit(*args)
+
+    def shutdown(self):
+        self._executor.shutdown()
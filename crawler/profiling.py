@@ -0,0 +1,332 @@
+"""
+Profile a running crawler over a number of batches, to see where its time goes
+without redeploying it.
+
+In `sample` mode a background thread records the stack of every other thread at
+a fixed interval, weighted by the CPU time it used since the last sample. This is cheap
+enough to leave on: the profile is written after every window of batches and
+then started again. In `cprofile` mode each crawl
+thread is also profiled deterministically by cProfile around `crawl_url` and
+page parsing, which is exact but slow, so it stops after the first window.
+From Python 3.12 only one cProfile profiler can be active at a time, and it
+covers every thread, so a single profiler runs for the whole window instead.
+If another profiler is already active, sample mode is used.
+
+Each window writes a pstats file, which can be loaded with `pstats.Stats` or
+tools such as snakeviz, and the stacks in the collapsed format used by
+flamegraph.pl and speedscope. Pages parsed in a parser process are not covered.
+"""
+import cProfile
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+
+MODES = ('sample', 'cprofile')
+DEFAULT_BATCHES = 10
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 0.01
+# From Python 3.12 cProfile uses sys.monitoring, which allows one profiler per process
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+
+logger = getLogger(__name__)
+
+
+def _frame_key(code):
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _thread_group(name: str) -> str:
+    """Group pool threads such as crawler_0 and crawler_1 under one name."""
+    return re.sub(r'_\d+$', '', name)
+
+
+def _thread_cpu_time(ident: int) -> Optional[float]:
+    """The CPU time used by a thread, or None if it isn't available on this platform."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class StackSampler:
+    """
+    The seconds spent in each stack, estimated by sampling every thread except
+    its own. Where per-thread CPU clocks are available each sample counts the
+    CPU time the thread used since the previous one, so idle threads don't
+    count, and otherwise the time between samples.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL_SECONDS):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._cpu_times = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = Counter()
+            cpu_times = {}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                cpu_time = cpu_times[ident] = _thread_cpu_time(ident)
+                if cpu_time is None:
+                    seconds = self.interval
+                else:
+                    seconds = cpu_time - self._cpu_times.get(ident, cpu_time)
+                    if seconds <= 0:
+                        continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_key(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                samples[_thread_group(names.get(ident, str(ident))), tuple(stack)] += seconds
+            self._cpu_times = cpu_times
+            with self._lock:
+                self._stacks.update(samples)
+
+    def pop_stacks(self) -> Counter:
+        """Return the stacks sampled since the last call, and start again."""
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+        return stacks
+
+
+def write_collapsed(stacks: Counter, path: Path):
+    """
+    Write stacks as lines of semicolon separated frames, root first, followed
+    by the number of microseconds spent in them.
+    """
+    with open(path, 'w') as output:
+        for (thread_name, stack), seconds in stacks.most_common():
+            microseconds = round(seconds * 1e6)
+            if microseconds == 0:
+                continue
+            frames = [thread_name] + [f"{name} ({os.path.basename(filename)}:{line})"
+                                      for filename, line, name in stack]
+            output.write(f"{';'.join(frame.replace(';', ':') for frame in frames)} {microseconds}\n")
+
+
+def samples_to_stats(stacks: Counter, interval: float) -> dict:
+    """
+    Turn sampled stacks into the statistics dict written by cProfile. There
+    are no call counts, so the number of sampling intervals spent in each
+    function is given instead.
+    """
+    stats = {}
+
+    def entry(function):
+        if function not in stats:
+            stats[function] = [0, 0, 0.0, 0.0, {}]
+        return stats[function]
+
+    for (_, stack), seconds in stacks.items():
+        count = max(round(seconds / interval), 1)
+        if not stack:
+            continue
+        leaf = entry(stack[-1])
+        leaf[2] += seconds
+        for function in set(stack):
+            function_entry = entry(function)
+            function_entry[0] += count
+            function_entry[1] += count
+            function_entry[3] += seconds
+        for caller, callee in set(zip(stack, stack[1:])):
+            callers = entry(callee)[4]
+            nc, cc, tt, ct = callers.get(caller, (0, 0, 0.0, 0.0))
+            callers[caller] = (nc + count, cc + count, tt + (seconds if callee == stack[-1] else 0.0), ct + seconds)
+
+    return {function: (cc, nc, tt, ct, callers) for function, (cc, nc, tt, ct, callers) in stats.items()}
+
+
+class _ThreadProfiles:
+    """One cProfile profiler per thread, enabled while a thread is inside a `profiled()` block."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def enable(self) -> bool:
+        """Start profiling the current thread, returning False if it can't be."""
+        local = self._local
+        if getattr(local, 'profile', None) is None:
+            local.profile = cProfile.Profile()
+            local.depth = 0
+            local.unavailable = False
+            with self._lock:
+                self._profiles.append(local.profile)
+        if local.unavailable:
+            return False
+        if local.depth == 0:
+            try:
+                local.profile.enable()
+            except ValueError:
+                # Another profiler is active, don't try again in this thread
+                logger.exception(f"Unable to profile thread {threading.current_thread().name}")
+                local.unavailable = True
+                return False
+        local.depth += 1
+        return True
+
+    def disable(self):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            local.profile.disable()
+
+    def stats(self) -> dict:
+        """The combined statistics of every thread, in the format written by cProfile."""
+        with self._lock:
+            profiles = list(self._profiles)
+        combined = {}
+        for profile in profiles:
+            # Threads may still be running with their profiler enabled, so take a snapshot without disabling it
+            profile.snapshot_stats()
+            for function, (cc, nc, tt, ct, callers) in profile.stats.items():
+                if function not in combined:
+                    combined[function] = (cc, nc, tt, ct, dict(callers))
+                    continue
+                old_cc, old_nc, old_tt, old_ct, old_callers = combined[function]
+                for caller, value in callers.items():
+                    old = old_callers.get(caller)
+                    old_callers[caller] = value if old is None else tuple(a + b for a, b in zip(old, value))
+                combined[function] = (old_cc + cc, old_nc + nc, old_tt + tt, old_ct + ct, old_callers)
+        return combined
+
+
+class BatchProfiler:
+    """
+    Profiles the crawler in windows of `batches` batches, writing the profile of
+    each window to `<path_prefix>.pstats` and `<path_prefix>.collapsed`.
+    """
+
+    def __init__(self, mode: str, path_prefix: Path, batches: int = DEFAULT_BATCHES,
+                 interval: float = DEFAULT_SAMPLE_INTERVAL_SECONDS):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profile mode {mode}")
+        self.mode = mode
+        self.path_prefix = path_prefix
+        self.batches = batches
+        self.interval = interval
+        self._sampler = StackSampler(interval)
+        self._thread_profiles = None
+        self._process_profile = None
+        if mode == 'cprofile':
+            if PER_THREAD_PROFILES:
+                self._thread_profiles = _ThreadProfiles()
+            else:
+                self._process_profile = cProfile.Profile()
+        self._num_batches = 0
+        self._window_start = None
+        self.running = False
+
+    def start(self):
+        self.path_prefix.parent.mkdir(exist_ok=True, parents=True)
+        if self._process_profile is not None:
+            try:
+                self._process_profile.enable()
+            except ValueError:
+                logger.exception("Unable to start cProfile, sampling stacks instead")
+                self.mode = 'sample'
+                self._process_profile = None
+        self._sampler.start()
+        self._window_start = time.monotonic()
+        self.running = True
+        logger.info(f"Profiling in {self.mode} mode, writing to {self.path_prefix}.* every {self.batches} batches")
+
+    def end_batch(self):
+        if not self.running:
+            return
+        self._num_batches += 1
+        if self._num_batches < self.batches:
+            return
+
+        if self.mode == 'cprofile':
+            # Deterministic profiling is too slow to leave on
+            self.running = False
+            self._sampler.stop()
+            if self._process_profile is not None:
+                self._process_profile.disable()
+        self._write()
+        self._num_batches = 0
+        self._window_start = time.monotonic()
+
+    def _write(self):
+        stacks = self._sampler.pop_stacks()
+        if self._thread_profiles is not None:
+            stats = self._thread_profiles.stats()
+        elif self._process_profile is not None:
+            self._process_profile.snapshot_stats()
+            stats = self._process_profile.stats
+        else:
+            stats = samples_to_stats(stacks, self.interval)
+
+        pstats_path = self.path_prefix.with_name(self.path_prefix.name + '.pstats')
+        collapsed_path = self.path_prefix.with_name(self.path_prefix.name + '.collapsed')
+        with open(pstats_path, 'wb') as output:
+            marshal.dump(stats, output)
+        write_collapsed(stacks, collapsed_path)
+        elapsed = time.monotonic() - self._window_start
+        logger.info(f"Wrote profile of {self._num_batches} batches over {elapsed:.0f} seconds to {pstats_path} "
+                    f"and {collapsed_path}")
+
+    def enable_thread(self):
+        if self.running and self._thread_profiles is not None:
+            return self._thread_profiles.enable()
+        return False
+
+    def disable_thread(self):
+        self._thread_profiles.disable()
+
+
+_profiler: Optional[BatchProfiler] = None
+
+
+def start_profiling(profiler: BatchProfiler):
+    global _profiler
+    _profiler = profiler
+    profiler.start()
+
+
+def end_batch():
+    """Let the profiler know a batch has been crawled, if one is running."""
+    if _profiler is not None:
+        _profiler.end_batch()
+
+
+class profiled:
+    """
+    Context manager around work done by a crawl thread, which is profiled with
+    cProfile in `cprofile` mode. Blocks can be nested.
+    """
+    __slots__ = ('_enabled',)
+
+    def __enter__(self):
+        self._enabled = _profiler is not None and _profiler.enable_thread()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._enabled:
+            _profiler.disable_thread()
@@ -0,0 +1,200 @@
+"""
+Cache of parsed robots.txt rules, keyed by scheme and netloc, with an optional
+on-disk store shared between crawler processes.
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+from urllib.robotparser import RobotFileParser
+
+from crawler.cache import MISSING, TtlLruCache
+
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL_SECONDS = 60 * 60
+# Hosts whose robots.txt could not be retrieved are allowed everything, but we retry sooner
+DEFAULT_NEGATIVE_TTL_SECONDS = 10 * 60
+# How long to wait for another process to release a lock on the store
+STORE_TIMEOUT_SECONDS = 5
+
+
+def parse_robots_lines(lines: Optional[list[str]]) -> Optional[RobotFileParser]:
+    if lines is None:
+        return None
+    rules = RobotFileParser()
+    rules.parse(lines)
+    return rules
+
+
+class RobotsStore:
+    """
+    A SQLite database of raw robots.txt files with an expiry time, which several
+    crawler processes can read and refresh concurrently. A NULL content is a
+    negative entry.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS robots
+                (host TEXT PRIMARY KEY, content TEXT, expires REAL NOT NULL)
+            ''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=STORE_TIMEOUT_SECONDS)
+
+    def get(self, host: str):
+        """
+        Returns a tuple of the robots.txt lines (or None for a negative entry) and
+        the number of seconds until the entry expires, or None if there is no
+        unexpired entry for the host.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT content, expires FROM robots WHERE host = ?', (host,)).fetchone()
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+        content, expires = row
+        remaining = expires - time.time()
+        if remaining <= 0:
+            return None
+        lines = content.splitlines() if content is not None else None
+        return lines, remaining
+
+    def put(self, host: str, lines: Optional[list[str]], ttl: float):
+        content = '\n'.join(lines) if lines is not None else None
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO robots (host, content, expires) VALUES (?, ?, ?)',
+                         (host, content, time.time() + ttl))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class RobotsCache:
+    """
+    A bounded, thread-safe LRU cache of robots rules.
+
+    A cached value of `None` is a negative entry: robots.txt was missing or could
+    not be fetched, so every URL on the host is allowed. Concurrent misses for the
+    same host wait for a single load rather than each fetching robots.txt. If a
+    store is given, misses are looked up there before fetching, and fetched files
+    are written back to it.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL_SECONDS,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL_SECONDS, store: Optional[RobotsStore] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self._cache = TtlLruCache(max_size)
+        # Guards the loads in progress, and looking up a host together with starting to load it
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._async_loading = {}
+
+    def get(self, key, load: Callable[[], Optional[list[str]]]) -> Optional[RobotFileParser]:
+        """
+        Returns the robots rules for the host identified by `key`. On a miss,
+        `load` is called to fetch the robots.txt lines, returning None if they
+        could not be retrieved.
+        """
+        while True:
+            with self._lock:
+                rules = self._cache.get(key)
+                if rules is not MISSING:
+                    return rules
+
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    self._cache.record_miss()
+                    break
+
+            # Another thread is fetching robots.txt for this host, wait for it then look again
+            loading.wait()
+
+        try:
+            stored = self._get_stored(key)
+            if stored is None:
+                stored = self._store_loaded(key, load())
+            rules, ttl = stored
+            self._cache.put(key, rules, ttl)
+            return rules
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    async def get_async(self, key, load: Callable[[], Awaitable[Optional[list[str]]]]) -> Optional[RobotFileParser]:
+        """
+        Equivalent of `get` for use from an event loop, where `load` is a coroutine
+        function. Concurrent misses are coalesced between tasks, not threads. The
+        store is read and written in the loop's default executor, so a locked
+        store doesn't stall the loop.
+        """
+        while True:
+            with self._lock:
+                rules = self._cache.get(key)
+                if rules is not MISSING:
+                    return rules
+
+                loading = self._async_loading.get(key)
+                if loading is None:
+                    loading = self._async_loading[key] = asyncio.Event()
+                    self._cache.record_miss()
+                    break
+
+            await loading.wait()
+
+        try:
+            loop = asyncio.get_running_loop()
+            stored = await loop.run_in_executor(None, self._get_stored, key)
+            if stored is None:
+                lines = await load()
+                stored = await loop.run_in_executor(None, self._store_loaded, key, lines)
+            rules, ttl = stored
+            self._cache.put(key, rules, ttl)
+            return rules
+        finally:
+            with self._lock:
+                del self._async_loading[key]
+            loading.set()
+
+    def peek(self, key) -> Optional[RobotFileParser]:
+        """Returns the cached rules for a host, or None if there are none, without fetching or counting a hit."""
+        rules = self._cache.peek(key)
+        return rules if rules is not MISSING else None
+
+    def _get_stored(self, key):
+        if self.store is None:
+            return None
+        stored = self.store.get('://'.join(key))
+        if stored is None:
+            return None
+        lines, remaining = stored
+        return parse_robots_lines(lines), remaining
+
+    def _store_loaded(self, key, lines: Optional[list[str]]):
+        ttl = self.ttl if lines is not None else self.negative_ttl
+        if self.store is not None:
+            self.store.put('://'.join(key), lines, ttl)
+        return parse_robots_lines(lines), ttl
+
+    def pop_stats(self):
+        """Return the hit and miss counts since the last call and reset them."""
+        return self._cache.pop_stats()
@@ -0,0 +1,110 @@
+"""
+Decide the order in which the URLs in a batch are crawled, so that no host is
+sent too many requests at once while the crawl as a whole stays busy.
+"""
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_HOST_DELAY_SECONDS = 0.25
+# Don't let a large Crawl-delay in robots.txt hold up the rest of the batch indefinitely
+MAX_CRAWL_DELAY_SECONDS = 5
+
+
+def get_host(url: str) -> str:
+    try:
+        return urlparse(url).netloc
+    except ValueError:
+        return ''
+
+
+class _Host:
+    __slots__ = ('urls', 'in_flight', 'next_allowed')
+
+    def __init__(self):
+        self.urls = deque()
+        self.in_flight = 0
+        self.next_allowed = 0.0
+
+
+class HostScheduler:
+    """
+    Hands out URLs round-robin across hosts. A host is only given another URL
+    if it has fewer than `max_per_host` in flight and the delay since its last
+    request has passed. The delay is the larger of `min_delay` and the host's
+    Crawl-delay, as returned by `get_crawl_delay(url)`.
+    """
+
+    def __init__(self, urls, max_per_host: int = DEFAULT_MAX_PER_HOST,
+                 min_delay: float = DEFAULT_HOST_DELAY_SECONDS,
+                 get_crawl_delay: Callable[[str], Optional[float]] = lambda url: None):
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+        self.get_crawl_delay = get_crawl_delay
+        self._hosts = OrderedDict()
+        self._num_pending = 0
+        self.add(urls)
+
+    def __len__(self):
+        """The number of URLs not yet handed out."""
+        return self._num_pending
+
+    def add(self, urls):
+        """Add more URLs, to be handed out after those already waiting for the same host."""
+        for url in urls:
+            self._hosts.setdefault(get_host(url), _Host()).urls.append(url)
+            self._num_pending += 1
+
+    def pop_ready(self, limit: int) -> list[str]:
+        """Return up to `limit` URLs that can be crawled now, interleaved across hosts."""
+        ready = []
+        now = time.monotonic()
+        while len(ready) < limit:
+            found = False
+            for name in list(self._hosts):
+                host = self._hosts[name]
+                if not host.urls and host.in_flight == 0 and host.next_allowed <= now:
+                    # Forget hosts we are done with, so a long-lived scheduler doesn't grow without bound
+                    del self._hosts[name]
+                    continue
+                if not host.urls or host.in_flight >= self.max_per_host or host.next_allowed > now:
+                    continue
+
+                url = host.urls.popleft()
+                host.in_flight += 1
+                host.next_allowed = now + self._get_delay(url)
+                self._num_pending -= 1
+                # Move the host to the back so the next URL comes from somewhere else
+                self._hosts.move_to_end(name)
+                ready.append(url)
+                found = True
+                if len(ready) >= limit:
+                    break
+            if not found:
+                break
+        return ready
+
+    def _get_delay(self, url: str) -> float:
+        crawl_delay = self.get_crawl_delay(url)
+        if crawl_delay is None:
+            return self.min_delay
+        return max(self.min_delay, min(float(crawl_delay), MAX_CRAWL_DELAY_SECONDS))
+
+    def release(self, url: str):
+        """Record that a URL handed out by `pop_ready` has finished."""
+        host = self._hosts[get_host(url)]
+        host.in_flight -= 1
+
+    def wait_time(self) -> Optional[float]:
+        """
+        The number of seconds until a host that is waiting out its delay can be
+        given another URL, or None if every remaining URL is waiting for a
+        request to its host to finish.
+        """
+        now = time.monotonic()
+        waits = [max(host.next_allowed - now, 0.0) for host in self._hosts.values()
+                 if host.urls and host.in_flight < self.max_per_host]
+        return min(waits) if waits else None
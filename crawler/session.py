@@ -0,0 +1,142 @@
+"""
+Pooled HTTP sessions shared by the crawler threads.
+
+Each crawl checks a session out of the pool for the duration of a URL. All the
+sessions share one adapter, whose urllib3 pool manager is thread-safe, so a
+keep-alive connection to a host can be reused by any thread, connections
+survive across URLs and batches, and the pool size caps the number of
+connections to each host.
+"""
+import http.cookiejar
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from crawler.dns import DnsCache, caching_connection_classes
+from crawler.timings import timed
+
+
+DEFAULT_POOL_SIZE = 4
+# Number of per-host connection pools each session keeps before evicting the least recently used
+NUM_HOST_POOLS = 100
+
+
+class ConnectionStats:
+    """Thread-safe counters of requests sent and connections opened."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': max(self.requests - self.new_connections, 0),
+            }
+
+
+def _timed_connection_class(base):
+    class TimedConnection(base):
+        def connect(self):
+            with timed('connect'):
+                super().connect()
+
+    TimedConnection.__name__ = TimedConnection.__qualname__ = base.__name__
+    return TimedConnection
+
+
+def _counting_pool_class(base, stats: ConnectionStats, connection_class=None):
+    class CountingConnectionPool(base):
+        ConnectionCls = _timed_connection_class(connection_class or base.ConnectionCls)
+
+        def _new_conn(self):
+            stats.record_new_connection()
+            return super()._new_conn()
+
+    # Keep the urllib3 name, it appears in the error messages we report
+    CountingConnectionPool.__name__ = CountingConnectionPool.__qualname__ = base.__name__
+    return CountingConnectionPool
+
+
+class CountingAdapter(HTTPAdapter):
+    def __init__(self, stats: ConnectionStats, dns_cache: Optional[DnsCache] = None, **kwargs):
+        self.stats = stats
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        http_class = https_class = None
+        if self.dns_cache is not None:
+            http_class, https_class = caching_connection_classes(self.dns_cache)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self.stats, http_class),
+            'https': _counting_pool_class(HTTPSConnectionPool, self.stats, https_class),
+        }
+
+    def send(self, request, *args, **kwargs):
+        self.stats.record_request()
+        return super().send(request, *args, **kwargs)
+
+
+class SessionPool:
+    """
+    A pool of `requests` sessions. Sessions are not safe to share between
+    threads, so each caller gets exclusive use of one while it is checked out,
+    but they all send requests through the same adapter. A request waits for a
+    connection if `pool_size` are already open to its host. Sessions don't
+    keep cookies, so one URL's response can't change the requests for the
+    URLs crawled after it with the same session.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, headers: dict = None, dns_cache: Optional[DnsCache] = None):
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self.dns_cache = dns_cache
+        self.stats = ConnectionStats()
+        self._lock = threading.Lock()
+        self._idle = []
+        self._adapter = CountingAdapter(self.stats, self.dns_cache, pool_connections=NUM_HOST_POOLS,
+                                        pool_maxsize=pool_size, pool_block=True)
+
+    def _new_session(self):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        session.mount('http://', self._adapter)
+        session.mount('https://', self._adapter)
+        return session
+
+    @contextmanager
+    def session(self):
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+        if session is None:
+            session = self._new_session()
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._idle.append(session)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+        self._adapter.close()
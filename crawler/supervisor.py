@@ -0,0 +1,94 @@
+"""
+Run several crawler processes from one entry point, restarting any that exit
+and logging their combined throughput.
+"""
+import multiprocessing
+import signal
+import sys
+import time
+from logging import getLogger
+from queue import Empty
+from typing import Callable
+
+
+STATS_INTERVAL_SECONDS = 60
+RESTART_DELAY_SECONDS = 10
+
+
+logger = getLogger(__name__)
+
+
+def _handle_sigterm(signum, frame):
+    sys.exit(0)
+
+
+class Supervisor:
+    """
+    Starts `num_workers` processes running `target(worker_index, batch_stats)`.
+    Workers put a dict with the number of `urls` and `errors` in each crawled
+    batch on the `batch_stats` queue.
+    """
+
+    def __init__(self, num_workers: int, target: Callable[[int, multiprocessing.Queue], None]):
+        self.num_workers = num_workers
+        self.target = target
+        self.batch_stats = multiprocessing.Queue()
+        self.processes = [None] * num_workers
+        self.restart_times = [0.0] * num_workers
+        self.num_restarts = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+        try:
+            self._supervise()
+        finally:
+            self._stop()
+
+    def _supervise(self):
+        urls = errors = 0
+        interval_start = time.monotonic()
+        while True:
+            self._start_workers()
+
+            try:
+                stats = self.batch_stats.get(timeout=1)
+                urls += stats['urls']
+                errors += stats['errors']
+            except Empty:
+                pass
+
+            elapsed = time.monotonic() - interval_start
+            if elapsed >= STATS_INTERVAL_SECONDS:
+                num_alive = sum(1 for p in self.processes if p is not None and p.is_alive())
+                logger.info(f"Workers crawled {urls} URLs in {elapsed:.0f} seconds ({urls / elapsed:.2f} per second), "
+                            f"{errors} errors, {num_alive}/{self.num_workers} workers running, "
+                            f"{self.num_restarts} restarts")
+                urls = errors = 0
+                interval_start = time.monotonic()
+
+    def _start_workers(self):
+        now = time.monotonic()
+        for i, process in enumerate(self.processes):
+            if process is not None:
+                if process.is_alive():
+                    continue
+                logger.warning(f"Worker {i} exited with code {process.exitcode}, "
+                               f"restarting in {RESTART_DELAY_SECONDS} seconds")
+                process.close()
+                self.processes[i] = None
+                self.restart_times[i] = now + RESTART_DELAY_SECONDS
+                self.num_restarts += 1
+
+            if now >= self.restart_times[i]:
+                process = multiprocessing.Process(target=self.target, args=(i, self.batch_stats),
+                                                  name=f"worker-{i}")
+                process.start()
+                self.processes[i] = process
+
+    def _stop(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
@@ -0,0 +1,225 @@
+"""
+Time the stages of crawling each URL and aggregate them into histograms, to
+tell whether a crawler is waiting on the network or on parsing.
+
+Code being timed wraps each stage in `timed(stage)`. The times are collected for
+the URL being crawled by the current thread or task, as set up by `collecting()`.
+Stages can be nested, and each records only the time not spent in the stages
+nested inside it, so no time is counted twice. For example the network time of
+fetching robots.txt counts towards `connect`, `first_byte` and `download`.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from typing import Optional
+
+
+STAGES = ('robots', 'connect', 'first_byte', 'download', 'html_to_dom', 'justext', 'links', 'extract')
+# Upper bounds in seconds of the histogram buckets, the last bucket has no upper bound
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_NAME = 'mwmbl_crawler_stage_seconds'
+
+
+logger = getLogger(__name__)
+
+
+class _Collector:
+    __slots__ = ('times', 'nested')
+
+    def __init__(self):
+        self.times = {}
+        # Time spent in nested stages, for each stage currently running
+        self.nested = [0.0]
+
+
+_collector: ContextVar[Optional[_Collector]] = ContextVar('timings_collector', default=None)
+
+
+class collecting:
+    """
+    Context manager that collects the times of the stages run inside it, in the
+    same thread or task, into a dict of seconds by stage.
+    """
+    __slots__ = ('_token', 'times')
+
+    def __enter__(self) -> dict:
+        collector = _Collector()
+        self._token = _collector.set(collector)
+        self.times = collector.times
+        return self.times
+
+    def __exit__(self, *exc_info):
+        _collector.reset(self._token)
+
+
+class timed:
+    """Context manager that adds the time spent inside it to `stage` of the URL being crawled, if any."""
+    __slots__ = ('stage', '_collector', '_start')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self._collector = collector = _collector.get()
+        if collector is not None:
+            collector.nested.append(0.0)
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        collector = self._collector
+        if collector is None:
+            return
+        elapsed = time.perf_counter() - self._start
+        nested = collector.nested.pop()
+        collector.times[self.stage] = collector.times.get(self.stage, 0.0) + elapsed - nested
+        collector.nested[-1] += elapsed
+
+
+def add_times(times: dict):
+    """Add times collected elsewhere, for example in a parser process, to the URL being crawled."""
+    collector = _collector.get()
+    if collector is None:
+        return
+    for stage, seconds in times.items():
+        collector.times[stage] = collector.times.get(stage, 0.0) + seconds
+        collector.nested[-1] += seconds
+
+
+class Histogram:
+    """Counts of values in each of BUCKETS, with their count, sum and maximum."""
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by interpolating within its bucket, as Prometheus does."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 6) if self.count else 0.0,
+            'p50': round(self.quantile(0.5), 6),
+            'p90': round(self.quantile(0.9), 6),
+            'max': round(self.max, 6),
+        }
+
+
+class StageTimings:
+    """
+    Thread-safe histograms of the time spent in each stage, for the current
+    batch and since the crawler started.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._batch = {stage: Histogram() for stage in STAGES}
+        self._total = {stage: Histogram() for stage in STAGES}
+
+    def record(self, times: dict):
+        """Record the stage times of one URL."""
+        with self._lock:
+            for stage, seconds in times.items():
+                histogram = self._batch.get(stage)
+                if histogram is None:
+                    histogram = self._batch[stage] = Histogram()
+                histogram.observe(seconds)
+
+    def pop_stats(self):
+        """Return a summary of each stage in the batch since the last call, and start a new batch."""
+        with self._lock:
+            batch = self._batch
+            self._batch = {stage: Histogram() for stage in STAGES}
+            for stage, histogram in batch.items():
+                self._total.setdefault(stage, Histogram()).merge(histogram)
+        return {stage: histogram.summary() for stage, histogram in batch.items() if histogram.count > 0}
+
+    def prometheus_text(self) -> str:
+        """The histograms of completed batches in the Prometheus text exposition format."""
+        with self._lock:
+            total = {stage: (list(histogram.counts), histogram.count, histogram.sum)
+                     for stage, histogram in self._total.items()}
+
+        lines = [
+            f'# HELP {METRIC_NAME} Time spent in each stage of crawling a URL.',
+            f'# TYPE {METRIC_NAME} histogram',
+        ]
+        for stage, (counts, count, total_seconds) in total.items():
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {total_seconds}')
+            lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def aiohttp_trace_config():
+    """An aiohttp trace config that times new connections as the `connect` stage."""
+    import aiohttp
+
+    async def on_connection_create_start(session, context, params):
+        context.connect_timer = timed('connect').__enter__()
+
+    async def on_connection_create_end(session, context, params):
+        context.connect_timer.__exit__(None, None, None)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def serve_metrics(timings: StageTimings, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serve the stage histograms at /metrics from a background thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = timings.prometheus_text().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return server
@@ -13,7 +13,7 @@ is_positive_integer ()
 	then
 		return 0
 	else
-		echo "The threads variable must contain a positive integer."
+		echo "The $2 variable must contain a positive integer."
 		return 1
 	fi
 }
@@ -22,11 +22,32 @@ if [ ! -n "${THREADS}" ]
 then
 	THREADS=1
 else
-	if ! is_positive_integer "$THREADS"
+	if ! is_positive_integer "$THREADS" threads
 	then
 		exit 1
 	fi
 fi
 
+if [ ! -n "${WORKERS}" ]
+then
+	WORKERS=1
+else
+	if ! is_positive_integer "$WORKERS" workers
+	then
+		exit 1
+	fi
+fi
+
+# Setting MAX_THREADS lets each worker adjust its number of threads between 1 and MAX_THREADS, starting at THREADS
+ADAPTIVE_ARGS=""
+if [ -n "${MAX_THREADS}" ]
+then
+	if ! is_positive_integer "$MAX_THREADS" max_threads
+	then
+		exit 1
+	fi
+	ADAPTIVE_ARGS="--adaptive --max-concurrency $MAX_THREADS"
+fi
+
 . "$CRAWLER_SCRIPT"/venv/bin/activate
-exec python "$CRAWLER_SCRIPT"/main.py -j "$THREADS"
+exec python "$CRAWLER_SCRIPT"/main.py -j "$THREADS" --workers "$WORKERS" $ADAPTIVE_ARGS
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Context-free classification of many paragraphs at once. The features that
+`classify_paragraphs` looks at are gathered into columns with one entry per
+paragraph, and classified with NumPy array operations. Without NumPy the
+paragraphs are classified one at a time by `justext.core.classify_paragraphs`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division, print_function, unicode_literals
+
+import re
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import core
+from .core import (LENGTH_LOW_DEFAULT, LENGTH_HIGH_DEFAULT, STOPWORDS_LOW_DEFAULT, STOPWORDS_HIGH_DEFAULT,
+                   MAX_LINK_DENSITY_DEFAULT, NO_HEADINGS_DEFAULT, define_stoplist)
+from .paragraph import HEADINGS_PATTERN
+
+SELECT_PATTERN = re.compile("select")
+
+BAD, SHORT, NEARGOOD, GOOD = range(4)
+CLASS_NAMES = ('bad', 'short', 'neargood', 'good')
+
+
+def _matching(pattern, strings):
+    "Flags the strings in which `pattern` is found, searching each distinct string once."
+    found = {string: pattern.search(string) is not None for string in set(strings)}
+    return array('b', [found[string] for string in strings])
+
+
+class ParagraphColumns(object):
+    """The features used to classify a list of paragraphs, as one array per feature."""
+
+    def __init__(self, paragraphs, stoplist):
+        texts = [paragraph.text for paragraph in paragraphs]
+        dom_paths = [paragraph.dom_path for paragraph in paragraphs]
+        self.lengths = array('q', map(len, texts))
+        self.words_counts = array('q', [paragraph.words_count for paragraph in paragraphs])
+        self.stopwords_counts = array('q', [paragraph.stopwords_count(stoplist) for paragraph in paragraphs])
+        self.link_chars_counts = array('q', [paragraph.chars_count_in_links for paragraph in paragraphs])
+        # many paragraphs share each DOM path
+        self.headings = _matching(HEADINGS_PATTERN, dom_paths)
+        self.selects = _matching(SELECT_PATTERN, dom_paths)
+        self.copyrights = array('b', [("\xa9" in text) or ("&copy" in text) for text in texts])
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def classify_columns(columns, length_low=LENGTH_LOW_DEFAULT, length_high=LENGTH_HIGH_DEFAULT,
+        stopwords_low=STOPWORDS_LOW_DEFAULT, stopwords_high=STOPWORDS_HIGH_DEFAULT,
+        max_link_density=MAX_LINK_DENSITY_DEFAULT):
+    """
+    Returns the context-free class of each paragraph, as an array of indexes
+    into CLASS_NAMES. Requires NumPy.
+    """
+    lengths = numpy.frombuffer(columns.lengths, dtype=numpy.int64)
+    words_counts = numpy.frombuffer(columns.words_counts, dtype=numpy.int64)
+    stopwords_counts = numpy.frombuffer(columns.stopwords_counts, dtype=numpy.int64)
+    link_chars_counts = numpy.frombuffer(columns.link_chars_counts, dtype=numpy.int64)
+    copyrights = numpy.frombuffer(columns.copyrights, dtype=numpy.int8).astype(bool)
+    selects = numpy.frombuffer(columns.selects, dtype=numpy.int8).astype(bool)
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        link_density = numpy.where(lengths > 0, link_chars_counts / lengths, 0.0)
+        stopword_density = numpy.where(words_counts > 0, stopwords_counts / words_counts, 0.0)
+
+    too_short = lengths < length_low
+    many_stopwords = stopword_density >= stopwords_high
+    # the first matching condition wins, as in the branches of classify_paragraphs
+    return numpy.select(
+        [
+            (link_density > max_link_density) | copyrights | selects,
+            too_short & (link_chars_counts > 0),
+            too_short,
+            many_stopwords & (lengths > length_high),
+            many_stopwords,
+            stopword_density >= stopwords_low,
+        ],
+        [BAD, BAD, SHORT, GOOD, NEARGOOD, NEARGOOD],
+        default=BAD,
+    )
+
+
+def classify_paragraphs(paragraphs, stoplist, length_low=LENGTH_LOW_DEFAULT,
+        length_high=LENGTH_HIGH_DEFAULT, stopwords_low=STOPWORDS_LOW_DEFAULT,
+        stopwords_high=STOPWORDS_HIGH_DEFAULT, max_link_density=MAX_LINK_DENSITY_DEFAULT,
+        no_headings=NO_HEADINGS_DEFAULT):
+    """
+    Context-free paragraph classification with the same result as
+    `justext.core.classify_paragraphs`, computed over columns of features
+    when NumPy is installed.
+    """
+    if numpy is None:
+        core.classify_paragraphs(paragraphs, stoplist, length_low, length_high,
+            stopwords_low, stopwords_high, max_link_density, no_headings)
+        return
+
+    columns = ParagraphColumns(paragraphs, define_stoplist(stoplist))
+    classes = classify_columns(columns, length_low, length_high, stopwords_low, stopwords_high, max_link_density)
+    headings = columns.headings if not no_headings else bytes(len(columns))
+    for paragraph, class_index, heading in zip(paragraphs, classes.tolist(), headings):
+        paragraph.cf_class = CLASS_NAMES[class_index]
+        paragraph.heading = bool(heading)
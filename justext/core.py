@@ -9,11 +9,12 @@ This software is licensed as described in the file LICENSE.rst.
 from __future__ import absolute_import
 from __future__ import division, print_function, unicode_literals
 
+import codecs
 import re
-from contextlib import contextmanager
+from collections import deque
 
 import lxml.html
-import lxml.sax
+from lxml.etree import Comment, ProcessingInstruction
 
 from functools import lru_cache
 
@@ -42,16 +43,11 @@ PARAGRAPH_TAGS = frozenset({
 DEFAULT_ENCODING = 'utf8'
 DEFAULT_ENC_ERRORS = 'replace'
 CHARSET_META_TAG_PATTERN = re.compile(br"""<meta[^>]+charset=["']?([^'"/>\s]+)""", re.IGNORECASE)
+# The charset meta tag belongs in the head, near the start of the page
+MAX_META_SNIFF_BYTES = 4096
 GOOD_OR_BAD = {'good', 'bad'}
 
 
-@contextmanager
-def ignored(*exceptions):
-    try:
-        yield
-    except tuple(exceptions):
-        pass
-
 class JustextError(Exception):
     "Base class for jusText exceptions."
 
@@ -60,15 +56,24 @@ class JustextInvalidOptions(JustextError):
     pass
 
 
-def html_to_dom(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=DEFAULT_ENC_ERRORS):
-    """Converts HTML to DOM."""
+def html_to_dom(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=DEFAULT_ENC_ERRORS,
+                http_encoding=None):
+    """
+    Converts HTML to DOM. `http_encoding` is the charset from the HTTP
+    Content-Type header, if any, which takes precedence over a meta tag.
+    """
     if isinstance(html, unicode):
         decoded_html = html
         # encode HTML for case it's XML with encoding declaration
         forced_encoding = encoding if encoding else default_encoding
         html = html.encode(forced_encoding, errors)
     else:
-        decoded_html = decode_html(html, default_encoding, encoding, errors)
+        declared_encoding = detect_encoding(html, encoding, http_encoding)
+        if _is_utf8(html, declared_encoding):
+            # Let lxml decode it, rather than decoding the page to a string
+            # only for lxml to convert it back
+            return lxml.html.fromstring(html, parser=lxml.html.HTMLParser(encoding="utf-8"))
+        decoded_html = _decode_html(html, declared_encoding, default_encoding, errors)
 
     try:
         dom = lxml.html.fromstring(decoded_html, parser=lxml.html.HTMLParser())
@@ -80,23 +85,66 @@ def html_to_dom(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=D
     return dom
 
 
-def decode_html(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=DEFAULT_ENC_ERRORS):
+def detect_encoding(html, encoding=None, http_encoding=None):
+    """
+    Returns the encoding of `html` bytes: `encoding` if given, otherwise the
+    first one Python knows of the HTTP charset and a charset meta tag within
+    the first MAX_META_SNIFF_BYTES. Returns None if neither is usable.
+    """
+    if encoding:
+        return encoding
+
+    if http_encoding and _is_known_encoding(http_encoding):
+        return http_encoding
+
+    match = CHARSET_META_TAG_PATTERN.search(html, 0, MAX_META_SNIFF_BYTES)
+    if match:
+        meta_encoding = match.group(1).decode("ASCII", "replace")
+        if _is_known_encoding(meta_encoding):
+            return meta_encoding
+
+    return None
+
+
+def _is_known_encoding(encoding):
+    try:
+        # also rejects codecs that don't decode bytes to text, like rot13.
+        # Empty bytes would be decoded without looking the codec up
+        b"a".decode(encoding, "replace")
+    except LookupError:
+        return False
+    return True
+
+
+def _is_utf8(html, declared_encoding):
+    "Whether `html` will be decoded as UTF-8 without any errors."
+    if declared_encoding is not None and codecs.lookup(declared_encoding).name != "utf-8":
+        return False
+    if html.isascii():
+        return True
+    try:
+        html.decode("utf8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def decode_html(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=DEFAULT_ENC_ERRORS,
+                http_encoding=None):
     """
     Converts a `html` containing an HTML page into Unicode.
-    Tries to guess character encoding from meta tag.
+    Uses the HTTP charset if given, otherwise tries to guess character
+    encoding from meta tag.
     """
     if isinstance(html, unicode):
         return html
 
-    if encoding:
-        return html.decode(encoding, errors)
+    return _decode_html(html, detect_encoding(html, encoding, http_encoding), default_encoding, errors)
 
-    match = CHARSET_META_TAG_PATTERN.search(html)
-    if match:
-        declared_encoding = match.group(1).decode("ASCII")
-        # proceed unknown encoding as if it wasn't found at all
-        with ignored(LookupError):
-            return html.decode(declared_encoding, errors)
+
+def _decode_html(html, declared_encoding, default_encoding, errors):
+    if declared_encoding:
+        return html.decode(declared_encoding, errors)
 
     # unknown encoding
     try:
@@ -110,28 +158,42 @@ def decode_html(html, default_encoding=DEFAULT_ENCODING, encoding=None, errors=D
             raise JustextError("Unable to decode the HTML to Unicode: " + unicode(e))
 
 
+PREPROCESSOR_OPTIONS = {
+    "processing_instructions": False,
+    "remove_unknown_tags": False,
+    "safe_attrs_only": False,
+    "page_structure": False,
+    "annoying_tags": False,
+    "frames": False,
+    "meta": False,
+    "links": False,
+    "javascript": False,
+    "scripts": True,
+    "comments": True,
+    "style": True,
+    "embedded": True,
+    "forms": True,
+    "kill_tags": ("head",),
+}
+_preprocessor_cleaner = Cleaner(**PREPROCESSOR_OPTIONS)
+
+# What the Cleaner above does, applied while paragraphs are made instead:
+# killed elements are dropped along with their content, removed elements are
+# replaced by their content.
+KILLED_TAGS = frozenset({
+    'head', 'script', 'style', 'applet', 'button', 'input', 'select', 'textarea',
+})
+REMOVED_TAGS = frozenset({'form', 'iframe', 'embed', 'layer', 'object', 'param'})
+XHTML_PREFIX = "{http://www.w3.org/1999/xhtml}"
+
+
 def preprocessor(dom):
     "Removes unwanted parts of DOM."
-    options = {
-        "processing_instructions": False,
-        "remove_unknown_tags": False,
-        "safe_attrs_only": False,
-        "page_structure": False,
-        "annoying_tags": False,
-        "frames": False,
-        "meta": False,
-        "links": False,
-        "javascript": False,
-        "scripts": True,
-        "comments": True,
-        "style": True,
-        "embedded": True,
-        "forms": True,
-        "kill_tags": ("head",),
-    }
-    cleaner = Cleaner(**options)
-
-    return cleaner.clean_html(dom)
+    return _preprocessor_cleaner.clean_html(dom)
+
+
+class _StopParagraphs(Exception):
+    "Raised to stop making paragraphs before the end of the DOM."
 
 
 # super(...).__init__() breaks Python 2.7 - TypeError: super() argument 1 must be type, not classobj
@@ -143,28 +205,164 @@ class ParagraphMaker(ContentHandler):
     """
 
     @classmethod
-    def make_paragraphs(cls, root):
-        """Converts DOM into paragraphs."""
-        handler = cls()
-        lxml.sax.saxify(root, handler)
+    def make_paragraphs(cls, root, stoplist=None, clean=False, on_paragraph=None):
+        """
+        Converts DOM into paragraphs. If a stoplist is given, the stopword count
+        of each paragraph is computed along with its text. With `clean`, the
+        parts of the DOM that `preprocessor` removes are skipped on the way,
+        so the DOM doesn't have to be copied and cleaned first.
+
+        If `on_paragraph` is given, it is called with each paragraph as soon
+        as it is complete, and the rest of the DOM is skipped once it returns
+        a true value.
+        """
+        handler = cls(stoplist, on_paragraph)
+        try:
+            if clean:
+                handler.walk_cleaned(root)
+            else:
+                handler.walk(root)
+        except _StopParagraphs:
+            pass
         return handler.paragraphs
 
-    def __init__(self):
+    def __init__(self, stoplist=None, on_paragraph=None):
+        self.stoplist = stoplist
+        self.on_paragraph = on_paragraph
         self.path = PathInfo()
         self.paragraphs = []
         self.paragraph = None
         self.link = False
         self.br = False
+        self._text_parts = []
         self._start_new_pragraph()
 
+    def walk(self, root):
+        """
+        Feeds the tree to the handler in the same order as `lxml.sax.saxify`,
+        without building the SAX event objects for every element.
+        """
+        # saxify also reports the text after processing instructions next to
+        # the root element
+        siblings = []
+        sibling = root.getprevious()
+        while getattr(sibling, "tag", None) is ProcessingInstruction:
+            siblings.append(sibling)
+            sibling = sibling.getprevious()
+        for sibling in reversed(siblings):
+            self._walk(sibling)
+
+        self._walk(root)
+
+        sibling = root.getnext()
+        while getattr(sibling, "tag", None) is ProcessingInstruction:
+            self._walk(sibling)
+            sibling = sibling.getnext()
+
+        self.endDocument()
+
+    def _walk(self, element):
+        tag = element.tag
+        # Comments, processing instructions and entities only contribute their tail
+        if isinstance(tag, str):
+            if tag[0] == "{":
+                tag = tag.split("}", 1)[1]
+            self._start_element(tag, element.get("href") if tag == "a" else None)
+            if element.text:
+                self.characters(element.text)
+            for child in element:
+                self._walk(child)
+            self._end_element(tag)
+        if element.tail:
+            self.characters(element.tail)
+
+    def walk_cleaned(self, root):
+        """
+        Equivalent to `walk(preprocessor(root))`. Text on either side of a
+        skipped element is joined before it is reported, as it is when the
+        Cleaner drops the element from the tree.
+        """
+        tag = self._cleaned_tag(root)
+        if tag in KILLED_TAGS:
+            # The Cleaner can't drop the root, so it empties it instead
+            tag = tag if tag == "html" else "div"
+            self._start_element(tag, None)
+            self._end_element(tag)
+        else:
+            in_object = tag == "object"
+            if tag in REMOVED_TAGS:
+                tag = "div"
+            self._walk_cleaned_element(root, tag, in_object)
+            self._add_text(root.tail)
+        self._flush_text()
+        self.endDocument()
+
+    @staticmethod
+    def _cleaned_tag(element):
+        tag = element.tag
+        if not isinstance(tag, str):
+            return tag
+        if tag.startswith(XHTML_PREFIX):
+            tag = tag[len(XHTML_PREFIX):]
+        return "img" if tag == "image" else tag
+
+    def _walk_cleaned(self, element, in_object):
+        tag = self._cleaned_tag(element)
+        if tag in KILLED_TAGS or tag is Comment:
+            pass
+        elif tag in REMOVED_TAGS:
+            if tag == "param" and not in_object:
+                pass
+            else:
+                self._add_text(element.text)
+                in_object = in_object or tag == "object"
+                for child in element:
+                    self._walk_cleaned(child, in_object)
+        elif tag == "link" and "stylesheet" in element.get("rel", "").lower():
+            pass
+        elif isinstance(tag, str):
+            self._walk_cleaned_element(element, tag, in_object)
+        else:
+            self._flush_text()
+        self._add_text(element.tail)
+
+    def _walk_cleaned_element(self, element, tag, in_object):
+        if tag[0] == "{":
+            tag = tag.split("}", 1)[1]
+        self._flush_text()
+        self._start_element(tag, element.get("href") if tag == "a" else None)
+        self._add_text(element.text)
+        for child in element:
+            self._walk_cleaned(child, in_object)
+        self._flush_text()
+        self._end_element(tag)
+
+    def _add_text(self, text):
+        if text:
+            self._text_parts.append(text)
+
+    def _flush_text(self):
+        if self._text_parts:
+            self.characters("".join(self._text_parts))
+            self._text_parts = []
+
     def _start_new_pragraph(self):
         if self.paragraph and self.paragraph.contains_text():
+            self.paragraph.finalize(self.stoplist)
             self.paragraphs.append(self.paragraph)
+            if self.on_paragraph is not None and self.on_paragraph(self.paragraph):
+                raise _StopParagraphs()
 
         self.paragraph = Paragraph(self.path)
 
     def startElementNS(self, name, qname, attrs):
-        name = name[1]
+        try:
+            href = attrs.getValueByQName('href')
+        except KeyError:
+            href = None
+        self._start_element(name[1], href)
+
+    def _start_element(self, name, href):
         self.path.append(name)
 
         if name in PARAGRAPH_TAGS or (name == "br" and self.br):
@@ -180,14 +378,14 @@ class ParagraphMaker(ContentHandler):
                 self.paragraph.append_text(' ')
             elif name == 'a':
                 self.link = True
-                try:
-                    self.paragraph.links.add(attrs.getValueByQName('href').strip())
-                except KeyError:
-                    pass
+                if href is not None:
+                    self.paragraph.links.add(href.strip())
             self.paragraph.tags_count += 1
 
     def endElementNS(self, name, qname):
-        name = name[1]
+        self._end_element(name[1])
+
+    def _end_element(self, name):
         self.path.pop()
 
         if name in PARAGRAPH_TAGS:
@@ -209,43 +407,84 @@ class ParagraphMaker(ContentHandler):
         self.br = False
 
 
+class PathNode(object):
+    """
+    One element on the path from the root, linked to its parent so that a
+    paragraph can keep its position without copying the path. The dotted DOM
+    path and the XPath are built on first use.
+    """
+    __slots__ = ('parent', 'tag_name', 'order', 'children', '_dom', '_xpath')
+
+    def __init__(self, parent=None, tag_name=None, order=0):
+        self.parent = parent
+        self.tag_name = tag_name
+        self.order = order
+        self.children = {}
+        self._dom = None
+        self._xpath = None
+
+    @property
+    def dom(self):
+        if self._dom is None:
+            if self.parent is None:
+                self._dom = ""
+            elif self.parent.parent is None:
+                self._dom = self.tag_name
+            else:
+                self._dom = self.parent.dom + "." + self.tag_name
+        return self._dom
+
+    @property
+    def xpath(self):
+        if self._xpath is None:
+            part = "%s[%d]" % (self.tag_name, self.order)
+            if self.parent is None:
+                self._xpath = "/"
+            elif self.parent.parent is None:
+                self._xpath = "/" + part
+            else:
+                self._xpath = self.parent.xpath + "/" + part
+        return self._xpath
+
+
 class PathInfo(object):
     def __init__(self):
-        # list of triples (tag name, order, children)
-        self._elements = []
+        self._root = self._current = PathNode()
+
+    @property
+    def node(self):
+        return self._current
 
     @property
     def dom(self):
-        return ".".join(e[0] for e in self._elements)
+        return self._current.dom
 
     @property
     def xpath(self):
-        return "/" + "/".join("%s[%d]" % e[:2] for e in self._elements)
+        return self._current.xpath
 
     def append(self, tag_name):
-        children = self._get_children()
+        # the root element is always the first of its name
+        children = self._current.children if self._current is not self._root else {}
         order = children.get(tag_name, 0) + 1
         children[tag_name] = order
 
-        xpath_part = (tag_name, order, {})
-        self._elements.append(xpath_part)
+        self._current = PathNode(self._current, tag_name, order)
 
         return self
 
-    def _get_children(self):
-        if not self._elements:
-            return {}
-
-        return self._elements[-1][2]
-
     def pop(self):
-        self._elements.pop()
+        self._current = self._current.parent
         return self
 
 
 @lru_cache(maxsize=128)  # 100 stoplists
 def define_stoplist(stoplist):
-    "Lower-case all words in stoplist and create frozen set."
+    """
+    Lower-case all words in stoplist and create frozen set. Pass the same object
+    each time, e.g. from `get_stoplist`, so that the cache lookup is by identity
+    rather than comparing every word.
+    """
     stoplist = frozenset(w.lower() for w in stoplist)
     return stoplist
 
@@ -258,31 +497,40 @@ def classify_paragraphs(paragraphs, stoplist, length_low=LENGTH_LOW_DEFAULT,
 
     stoplist = define_stoplist(stoplist)
     for paragraph in paragraphs:
-        length = len(paragraph)
-        stopword_density = paragraph.stopwords_density(stoplist)
-        link_density = paragraph.links_density()
-        paragraph.heading = bool(not no_headings and paragraph.is_heading)
+        classify_paragraph(paragraph, stoplist, length_low, length_high,
+            stopwords_low, stopwords_high, max_link_density, no_headings)
 
-        if link_density > max_link_density:
-            paragraph.cf_class = 'bad'
-        elif ('\xa9' in paragraph.text) or ('&copy' in paragraph.text):
-            paragraph.cf_class = 'bad'
-        elif 'select' in paragraph.dom_path:
+
+def classify_paragraph(paragraph, stoplist, length_low=LENGTH_LOW_DEFAULT,
+        length_high=LENGTH_HIGH_DEFAULT, stopwords_low=STOPWORDS_LOW_DEFAULT,
+        stopwords_high=STOPWORDS_HIGH_DEFAULT, max_link_density=MAX_LINK_DENSITY_DEFAULT,
+        no_headings=NO_HEADINGS_DEFAULT):
+    "Context-free classification of a single paragraph. The stoplist must be a set."
+    length = len(paragraph)
+    stopword_density = paragraph.stopwords_density(stoplist)
+    link_density = paragraph.links_density()
+    paragraph.heading = bool(not no_headings and paragraph.is_heading)
+
+    if link_density > max_link_density:
+        paragraph.cf_class = 'bad'
+    elif ('\xa9' in paragraph.text) or ('&copy' in paragraph.text):
+        paragraph.cf_class = 'bad'
+    elif 'select' in paragraph.dom_path:
+        paragraph.cf_class = 'bad'
+    elif length < length_low:
+        if paragraph.chars_count_in_links > 0:
             paragraph.cf_class = 'bad'
-        elif length < length_low:
-            if paragraph.chars_count_in_links > 0:
-                paragraph.cf_class = 'bad'
-            else:
-                paragraph.cf_class = 'short'
-        elif stopword_density >= stopwords_high:
-            if length > length_high:
-                paragraph.cf_class = 'good'
-            else:
-                paragraph.cf_class = 'neargood'
-        elif stopword_density >= stopwords_low:
-            paragraph.cf_class = 'neargood'
         else:
-            paragraph.cf_class = 'bad'
+            paragraph.cf_class = 'short'
+    elif stopword_density >= stopwords_high:
+        if length > length_high:
+            paragraph.cf_class = 'good'
+        else:
+            paragraph.cf_class = 'neargood'
+    elif stopword_density >= stopwords_low:
+        paragraph.cf_class = 'neargood'
+    else:
+        paragraph.cf_class = 'bad'
 
 
 def _get_neighbour(i, paragraphs, ignore_neargood, inc, boundary):
@@ -314,88 +562,285 @@ def get_next_neighbour(i, paragraphs, ignore_neargood):
     return _get_neighbour(i, paragraphs, ignore_neargood, 1, len(paragraphs))
 
 
+def _prev_neighbours(classes, ignore_neargood):
+    """
+    The result of `get_prev_neighbour` for every paragraph with the given
+    classes, in a single pass.
+    """
+    neighbours = []
+    neighbour = 'bad'
+    for c in classes:
+        neighbours.append(neighbour)
+        if c in GOOD_OR_BAD or (c == 'neargood' and not ignore_neargood):
+            neighbour = c
+    return neighbours
+
+
+def _next_neighbours(classes, ignore_neargood):
+    "The result of `get_next_neighbour` for every paragraph, in a single pass."
+    return _prev_neighbours(classes[::-1], ignore_neargood)[::-1]
+
+
+def _good_within_distance(paragraphs, classes, max_heading_distance):
+    """
+    For every paragraph, whether a good one follows it before more than
+    `max_heading_distance` characters of other paragraphs.
+    """
+    found = [False] * len(paragraphs)
+    # distance from the end of each paragraph to the next good one
+    distance = None
+    for i in range(len(paragraphs) - 1, -1, -1):
+        found[i] = distance is not None and distance <= max_heading_distance
+        if classes[i] == 'good':
+            distance = 0
+        elif distance is not None:
+            distance += len(paragraphs[i].text)
+    return found
+
+
 def revise_paragraph_classification(paragraphs, max_heading_distance=MAX_HEADING_DISTANCE_DEFAULT):
     """
     Context-sensitive paragraph classification. Assumes that classify_pragraphs
     has already been called.
+
+    The neighbours of every paragraph are found with a pass in each direction
+    instead of scanning from each one, so this takes linear time.
     """
 
-    # good headings
+    # good headings, which look at the classes of the following paragraphs
+    # from before the copy
+    good_follows = _good_within_distance(
+        paragraphs, [paragraph.class_type for paragraph in paragraphs], max_heading_distance)
     for i, paragraph in enumerate(paragraphs):
         # copy classes
         paragraph.class_type = paragraph.cf_class
-        if not (paragraph.heading and paragraph.class_type == 'short'):
-            continue
-        j = i + 1
-        distance = 0
-        while j < len(paragraphs) and distance <= max_heading_distance:
-            if paragraphs[j].class_type == 'good':
-                paragraph.class_type = 'neargood'
-                break
-            distance += len(paragraphs[j].text)
-            j += 1
+        if paragraph.heading and paragraph.class_type == 'short' and good_follows[i]:
+            paragraph.class_type = 'neargood'
 
     # classify short
-    new_classes = {}
+    classes = [paragraph.class_type for paragraph in paragraphs]
+    prev_neighbours = _prev_neighbours(classes, ignore_neargood=True)
+    next_neighbours = _next_neighbours(classes, ignore_neargood=True)
+    prev_neighbours_neargood = _prev_neighbours(classes, ignore_neargood=False)
+    next_neighbours_neargood = _next_neighbours(classes, ignore_neargood=False)
     for i, paragraph in enumerate(paragraphs):
         if paragraph.class_type != 'short':
             continue
-        prev_neighbour = get_prev_neighbour(i, paragraphs, ignore_neargood=True)
-        next_neighbour = get_next_neighbour(i, paragraphs, ignore_neargood=True)
+        prev_neighbour = prev_neighbours[i]
+        next_neighbour = next_neighbours[i]
         if prev_neighbour == 'good' and next_neighbour == 'good':
-            new_classes[i] = 'good'
+            classes[i] = 'good'
         elif prev_neighbour == 'bad' and next_neighbour == 'bad':
-            new_classes[i] = 'bad'
+            classes[i] = 'bad'
         # it must be set(['good', 'bad'])
-        elif (prev_neighbour == 'bad' and get_prev_neighbour(i, paragraphs, ignore_neargood=False) == 'neargood') or \
-             (next_neighbour == 'bad' and get_next_neighbour(i, paragraphs, ignore_neargood=False) == 'neargood'):
-            new_classes[i] = 'good'
+        elif (prev_neighbour == 'bad' and prev_neighbours_neargood[i] == 'neargood') or \
+             (next_neighbour == 'bad' and next_neighbours_neargood[i] == 'neargood'):
+            classes[i] = 'good'
         else:
-            new_classes[i] = 'bad'
+            classes[i] = 'bad'
 
-    for i, c in new_classes.items():
-        paragraphs[i].class_type = c
+    for paragraph, c in zip(paragraphs, classes):
+        paragraph.class_type = c
 
-    # revise neargood
+    # revise neargood, where the earlier near-good paragraphs have already
+    # been revised when a later one looks back
+    next_neighbours = _next_neighbours(classes, ignore_neargood=True)
+    prev_neighbour = 'bad'
     for i, paragraph in enumerate(paragraphs):
-        if paragraph.class_type != 'neargood':
-            continue
-        prev_neighbour = get_prev_neighbour(i, paragraphs, ignore_neargood=True)
-        next_neighbour = get_next_neighbour(i, paragraphs, ignore_neargood=True)
-        if (prev_neighbour, next_neighbour) == ('bad', 'bad'):
-            paragraph.class_type = 'bad'
-        else:
-            paragraph.class_type = 'good'
+        if paragraph.class_type == 'neargood':
+            if (prev_neighbour, next_neighbours[i]) == ('bad', 'bad'):
+                paragraph.class_type = 'bad'
+            else:
+                paragraph.class_type = 'good'
+        if paragraph.class_type in GOOD_OR_BAD:
+            prev_neighbour = paragraph.class_type
 
     # more good headings
+    good_follows = _good_within_distance(
+        paragraphs, [paragraph.class_type for paragraph in paragraphs], max_heading_distance)
     for i, paragraph in enumerate(paragraphs):
-        if not (paragraph.heading and paragraph.class_type == 'bad' and paragraph.cf_class != 'bad'):
-            continue
-        j = i + 1
-        distance = 0
-        while j < len(paragraphs) and distance <= max_heading_distance:
-            if paragraphs[j].class_type == 'good':
-                paragraph.class_type = 'good'
-                break
-            distance += len(paragraphs[j].text)
-            j += 1
+        if paragraph.heading and paragraph.class_type == 'bad' and paragraph.cf_class != 'bad' and good_follows[i]:
+            paragraph.class_type = 'good'
+
+
+class IncrementalClassifier(object):
+    """
+    Classifies paragraphs one at a time, in document order, with the same
+    result as `classify_paragraphs` followed by `revise_paragraph_classification`.
+
+    The class of a short or near-good paragraph only depends on the paragraphs
+    up to the next good or bad one, and a heading only looks
+    `max_heading_distance` characters further, so each paragraph is passed
+    to `consume` as soon as its final class is known. Once `consume` returns
+    a true value no more paragraphs are consumed.
+    """
+
+    def __init__(self, stoplist, consume, length_low=LENGTH_LOW_DEFAULT,
+            length_high=LENGTH_HIGH_DEFAULT, stopwords_low=STOPWORDS_LOW_DEFAULT,
+            stopwords_high=STOPWORDS_HIGH_DEFAULT, max_link_density=MAX_LINK_DENSITY_DEFAULT,
+            max_heading_distance=MAX_HEADING_DISTANCE_DEFAULT, no_headings=NO_HEADINGS_DEFAULT):
+        self.stoplist = define_stoplist(stoplist)
+        self.consume = consume
+        self.options = (length_low, length_high, stopwords_low, stopwords_high, max_link_density, no_headings)
+        self.max_heading_distance = max_heading_distance
+        self.paragraphs = []
+        self.done = False
+        # short and near-good paragraphs since the last good or bad one
+        self._block = []
+        # class of the last good or bad paragraph before the block
+        self._block_prev_class = 'bad'
+        # paragraphs with a revised class, waiting for a heading before them
+        self._revised = deque()
+        self._heading_scan_index = 1
+        self._heading_scan_distance = 0
+
+    def add(self, paragraph):
+        """Classify the next paragraph. Returns True once `consume` has had enough."""
+        classify_paragraph(paragraph, self.stoplist, *self.options)
+        if paragraph.cf_class in GOOD_OR_BAD:
+            self._revise_block(paragraph.cf_class)
+            paragraph.class_type = paragraph.cf_class
+            self._block_prev_class = paragraph.cf_class
+            self._revised.append(paragraph)
+        else:
+            self._block.append(paragraph)
+
+        self._consume_revised(False)
+        return self.done
+
+    def finish(self):
+        """Classify the paragraphs still waiting for the ones after them, at the end of the document."""
+        self._revise_block('bad')
+        self._consume_revised(True)
+
+    def _revise_block(self, next_class):
+        """
+        Revise the classes of the short and near-good paragraphs between two
+        good or bad ones, as `revise_paragraph_classification` does.
+        """
+        block = self._block
+        if not block:
+            return
+        prev_class = self._block_prev_class
+
+        # classify short
+        neargood_after = [False] * len(block)
+        found = False
+        for i in range(len(block) - 1, -1, -1):
+            neargood_after[i] = found
+            found = found or block[i].cf_class == 'neargood'
+
+        new_classes = []
+        neargood_before = False
+        for i, paragraph in enumerate(block):
+            if paragraph.cf_class != 'short':
+                neargood_before = True
+                new_classes.append('neargood')
+            elif prev_class == 'good' and next_class == 'good':
+                new_classes.append('good')
+            elif prev_class == 'bad' and next_class == 'bad':
+                new_classes.append('bad')
+            elif (prev_class == 'bad' and neargood_before) or (next_class == 'bad' and neargood_after[i]):
+                new_classes.append('good')
+            else:
+                new_classes.append('bad')
+
+        # revise neargood
+        next_classes = [None] * len(block)
+        following = next_class
+        for i in range(len(block) - 1, -1, -1):
+            next_classes[i] = following
+            if new_classes[i] != 'neargood':
+                following = new_classes[i]
+
+        for i, paragraph in enumerate(block):
+            if new_classes[i] == 'neargood':
+                if prev_class == 'bad' and next_classes[i] == 'bad':
+                    new_classes[i] = 'bad'
+                else:
+                    new_classes[i] = 'good'
+            paragraph.class_type = prev_class = new_classes[i]
+
+        self._revised.extend(block)
+        self._block = []
+
+    def _consume_revised(self, at_end):
+        revised = self._revised
+        while revised and not self.done:
+            paragraph = revised[0]
+            if paragraph.heading and paragraph.class_type == 'bad' and paragraph.cf_class != 'bad':
+                if not self._revise_heading(at_end):
+                    return
+            revised.popleft()
+            self._heading_scan_index = 1
+            self._heading_scan_distance = 0
+            self.paragraphs.append(paragraph)
+            if self.consume(paragraph):
+                self.done = True
+
+    def _revise_heading(self, at_end):
+        """
+        Look for a good paragraph following the first revised one, a heading,
+        continuing from where the last call stopped. Returns False if the
+        paragraphs that decide it haven't been revised yet.
+        """
+        revised = self._revised
+        while self._heading_scan_distance <= self.max_heading_distance:
+            if self._heading_scan_index >= len(revised):
+                return at_end
+            following = revised[self._heading_scan_index]
+            if following.class_type == 'good':
+                revised[0].class_type = 'good'
+                return True
+            self._heading_scan_distance += len(following.text)
+            self._heading_scan_index += 1
+        return True
 
 
 def justext_from_dom(dom, stoplist, length_low=LENGTH_LOW_DEFAULT,
                      length_high=LENGTH_HIGH_DEFAULT, stopwords_low=STOPWORDS_LOW_DEFAULT,
                      stopwords_high=STOPWORDS_HIGH_DEFAULT, max_link_density=MAX_LINK_DENSITY_DEFAULT,
                      max_heading_distance=MAX_HEADING_DISTANCE_DEFAULT, no_headings=NO_HEADINGS_DEFAULT,
-                     preprocessor=preprocessor):
+                     preprocessor=None, classify_paragraphs=classify_paragraphs):
     """
     Converts an HTML page into a list of classified paragraphs. Each paragraph
     is represented as instance of class ˙˙justext.paragraph.Paragraph˙˙.
-    """
-    dom_preprocessed = preprocessor(dom)
 
-    paragraphs = ParagraphMaker.make_paragraphs(dom_preprocessed)
+    By default the DOM is cleaned as by ˙˙preprocessor˙˙ while the paragraphs
+    are made. A custom ˙˙preprocessor˙˙ is called on the DOM first instead.
+    The context-free classification can be replaced too, for example with
+    ˙˙justext.columns.classify_paragraphs˙˙.
+    """
+    if preprocessor is None:
+        paragraphs = ParagraphMaker.make_paragraphs(dom, define_stoplist(stoplist), clean=True)
+    else:
+        paragraphs = ParagraphMaker.make_paragraphs(preprocessor(dom), define_stoplist(stoplist))
 
     classify_paragraphs(paragraphs, stoplist, length_low, length_high,
         stopwords_low, stopwords_high, max_link_density, no_headings)
     revise_paragraph_classification(paragraphs, max_heading_distance)
 
     return paragraphs
+
+
+def justext_from_dom_until(dom, stoplist, consume, length_low=LENGTH_LOW_DEFAULT,
+                           length_high=LENGTH_HIGH_DEFAULT, stopwords_low=STOPWORDS_LOW_DEFAULT,
+                           stopwords_high=STOPWORDS_HIGH_DEFAULT, max_link_density=MAX_LINK_DENSITY_DEFAULT,
+                           max_heading_distance=MAX_HEADING_DISTANCE_DEFAULT, no_headings=NO_HEADINGS_DEFAULT,
+                           preprocessor=None):
+    """
+    Like ˙˙justext_from_dom˙˙, but classifies the paragraphs while they are
+    made, passing each to ˙˙consume˙˙ once its class is final. Making and
+    classifying paragraphs stops as soon as ˙˙consume˙˙ returns a true value.
+    Returns the paragraphs that were consumed.
+    """
+    classifier = IncrementalClassifier(stoplist, consume, length_low, length_high, stopwords_low,
+        stopwords_high, max_link_density, max_heading_distance, no_headings)
+    if preprocessor is None:
+        ParagraphMaker.make_paragraphs(dom, classifier.stoplist, clean=True, on_paragraph=classifier.add)
+    else:
+        ParagraphMaker.make_paragraphs(preprocessor(dom), classifier.stoplist, on_paragraph=classifier.add)
+
+    if not classifier.done:
+        classifier.finish()
+    return classifier.paragraphs
@@ -13,14 +13,43 @@ HEADINGS_PATTERN = re.compile(r"\bh\d\b")
 
 class Paragraph(object):
     """Object representing one block of text in HTML."""
+    __slots__ = (
+        'dom_path', '_path', 'text_nodes', 'chars_count_in_links', 'tags_count',
+        'class_type', 'cf_class', 'heading', 'links',
+        '_text', '_words_count', '_stopwords', '_stopwords_count',
+    )
+
     def __init__(self, path):
         self.dom_path = path.dom
-        self.xpath = path.xpath
+        self._path = path.node
         self.text_nodes = []
         self.chars_count_in_links = 0
         self.tags_count = 0
         self.class_type = ""  # short | neargood | good | bad
+        self.cf_class = ""
+        self.heading = False
         self.links: set[str] = set()
+        self._text = None
+        self._words_count = 0
+        self._stopwords = None
+        self._stopwords_count = 0
+
+    def finalize(self, stopwords=None):
+        """
+        Compute the text and its word counts once the paragraph is complete,
+        so that classification doesn't rebuild them on every access.
+        """
+        text = normalize_whitespace("".join(self.text_nodes).strip())
+        words = text.split()
+        self._text = text
+        self._words_count = len(words)
+        if stopwords is not None:
+            self._stopwords = stopwords
+            self._stopwords_count = sum(word.lower() in stopwords for word in words)
+
+    @property
+    def xpath(self):
+        return self._path.xpath
 
     @property
     def is_heading(self):
@@ -32,15 +61,18 @@ class Paragraph(object):
 
     @property
     def text(self):
-        text = "".join(self.text_nodes)
-        return normalize_whitespace(text.strip())
+        if self._text is None:
+            self.finalize()
+        return self._text
 
     def __len__(self):
         return len(self.text)
 
     @property
     def words_count(self):
-        return len(self.text.split())
+        if self._text is None:
+            self.finalize()
+        return self._words_count
 
     def contains_text(self):
         return bool(self.text_nodes)
@@ -48,10 +80,14 @@ class Paragraph(object):
     def append_text(self, text):
         text = normalize_whitespace(text)
         self.text_nodes.append(text)
+        self._text = None
+        self._stopwords = None
         return text
 
     def stopwords_count(self, stopwords):
-        return sum(word.lower() in stopwords for word in self.text.split())
+        if stopwords is not self._stopwords:
+            self.finalize(stopwords)
+        return self._stopwords_count
 
     def stopwords_density(self, stopwords):
         if self.words_count == 0:
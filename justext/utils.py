@@ -8,6 +8,8 @@ import os
 import sys
 import pkgutil
 
+from functools import lru_cache
+
 MULTIPLE_WHITESPACE_PATTERN = re.compile(r"\s+", re.UNICODE)
 
 
@@ -48,8 +50,12 @@ def get_stoplists():
     return frozenset(stoplist_names)
 
 
+@lru_cache(maxsize=None)
 def get_stoplist(language):
-    """Returns an built-in stop-list for the language as a set of words."""
+    """
+    Returns an built-in stop-list for the language as a set of words. Each
+    stop-list is loaded once, and the same frozen set is returned on every call.
+    """
     file_path = os.path.join("stoplists", "%s.txt" % language)
     try:
         stopwords = pkgutil.get_data("justext", file_path)
@@ -1,18 +1,22 @@
+import asyncio
 import json
 import logging
-import re
+import multiprocessing
 import sys
 import time
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
 from datetime import datetime
-from functools import reduce
+from functools import reduce, partial
 from logging import getLogger
-from multiprocessing.pool import ThreadPool
 from pathlib import Path
+from queue import Empty, Queue
 from ssl import SSLCertVerificationError
-from typing import Optional
-from urllib.parse import urlparse, urlunsplit, urljoin
-from urllib.robotparser import RobotFileParser
+from threading import Thread
+from typing import Callable, Optional
+from urllib.parse import urlparse, urlunsplit
 from uuid import uuid4
 
 import requests
@@ -21,6 +25,20 @@ from urllib3.exceptions import NewConnectionError, MaxRetryError
 
 from xdg import xdg_config_home
 
+from crawler.batches import BatchBody, COMPRESSIONS, DEFAULT_COMPRESSION, compression_available
+from crawler.concurrency import ConcurrencyController
+from crawler.dns import DnsCache, DEFAULT_TTL_SECONDS as DNS_TTL_SECONDS
+from crawler.links import normalize_link
+from crawler.outbox import Outbox, OutboxSender, RejectedBatch
+from crawler.parsing import ParserPool
+from crawler.profiling import (BatchProfiler, DEFAULT_BATCHES as DEFAULT_PROFILE_BATCHES,
+                               DEFAULT_SAMPLE_INTERVAL_SECONDS, MODES as PROFILE_MODES, end_batch, profiled,
+                               start_profiling)
+from crawler.robots import RobotsCache, RobotsStore
+from crawler.scheduler import HostScheduler, DEFAULT_MAX_PER_HOST, DEFAULT_HOST_DELAY_SECONDS
+from crawler.session import SessionPool, DEFAULT_POOL_SIZE
+from crawler.supervisor import Supervisor
+from crawler.timings import StageTimings, add_times, aiohttp_trace_config, collecting, serve_metrics, timed
 from justext import core, utils
 from justext.core import html_to_dom
 from justext.paragraph import Paragraph
@@ -36,9 +54,10 @@ POST_BATCH_URL = '/api/v1/crawler/batches/'
 POST_NEW_BATCH_URL = '/api/v1/crawler/batches/new'
 
 TIMEOUT_SECONDS = 3
+URL_DEADLINE_SECONDS = 10
 MAX_FETCH_SIZE = 1024*1024
-MAX_URL_LENGTH = 150
-BAD_URL_REGEX = re.compile(r'\/\/localhost\b|\.jpg$|\.png$|\.js$|\.gz$|\.zip$|\.pdf$|\.bz2$|\.ipynb$|\.py$')
+FETCH_CHUNK_SIZE = 64*1024
+HTML_CONTENT_TYPES = {'text/html', 'application/xhtml+xml'}
 MAX_NEW_LINKS = 50
 MAX_EXTRA_LINKS = 50
 NUM_TITLE_CHARS = 65
@@ -46,39 +65,64 @@ NUM_EXTRACT_CHARS = 155
 DEFAULT_ENCODING = 'utf8'
 DEFAULT_ENC_ERRORS = 'replace'
 MAX_SITE_URLS = 100
+# In adaptive mode, the default maximum concurrency is this many times the number of threads
+DEFAULT_MAX_CONCURRENCY_FACTOR = 4
+# Statuses for which the coordinator may accept the same batch later
+RETRY_STATUS_CODES = {408, 429}
 
 
 logger = getLogger(__name__)
 
 
-def fetch(url):
+def fetch(url, session: requests.Session, html_only: bool = False, chunk_size: int = FETCH_CHUNK_SIZE):
     """
     Fetch with a maximum timeout and maximum fetch size to avoid big pages bringing us down.
+    If `html_only` is set, responses that declare a non-HTML content type are abandoned
+    before the body is read. Returns the status code, body and response headers.
 
     https://stackoverflow.com/a/22347526
     """
 
-    r = requests.get(url, stream=True, timeout=TIMEOUT_SECONDS, headers=HEADERS)
+    with timed('first_byte'):
+        r = session.get(url, stream=True, timeout=TIMEOUT_SECONDS)
+    with r, timed('download'):
+        if html_only:
+            content_type = r.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type and content_type not in HTML_CONTENT_TYPES:
+                raise ValueError(f"Unsupported content type {content_type}")
 
-    size = 0
-    start = time.time()
+        content_length = r.headers.get('Content-Length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > MAX_FETCH_SIZE:
+            raise ValueError(f"Content length {content_length} exceeds maximum fetch size")
 
-    content = b""
-    for chunk in r.iter_content(1024):
-        if time.time() - start > TIMEOUT_SECONDS:
-            raise ValueError('Timeout reached')
+        size = 0
+        start = time.monotonic()
 
-        content += chunk
+        chunks = []
+        for chunk in r.iter_content(chunk_size):
+            if time.monotonic() - start > TIMEOUT_SECONDS:
+                raise ValueError('Timeout reached')
+
+            size += len(chunk)
+            if size > MAX_FETCH_SIZE:
+                logger.debug(f"Maximum size reached for URL {url}")
+                chunks.append(chunk[:len(chunk) - (size - MAX_FETCH_SIZE)])
+                break
+            chunks.append(chunk)
+
+        return r.status_code, b"".join(chunks), r.headers
 
-        size += len(chunk)
-        if size > MAX_FETCH_SIZE:
-            logger.debug(f"Maximum size reached for URL {url}")
-            break
 
-    return r.status_code, content
+def get_charset(headers) -> Optional[str]:
+    """The charset parameter of the Content-Type header, if there is one."""
+    for parameter in headers.get('Content-Type', '').split(';')[1:]:
+        name, _, value = parameter.partition('=')
+        if name.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or None
+    return None
 
 
-def robots_allowed(url):
+def robots_allowed(url, session: requests.Session, robots_cache: RobotsCache):
     try:
         parsed_url = urlparse(url)
     except ValueError:
@@ -90,19 +134,35 @@ def robots_allowed(url):
         return True
 
     robots_url = urlunsplit((parsed_url.scheme, parsed_url.netloc, 'robots.txt', '', ''))
+    parse_robots = robots_cache.get((parsed_url.scheme, parsed_url.netloc),
+                                    partial(fetch_robots, robots_url, session))
+    if parse_robots is None:
+        return True
+
+    allowed = parse_robots.can_fetch('Mwmbl', url)
+    logger.debug(f"Robots allowed for {url}: {allowed}")
+    return allowed
 
-    parse_robots = RobotFileParser(robots_url)
 
+def fetch_robots(robots_url, session: requests.Session) -> Optional[list[str]]:
+    """
+    Fetch a robots.txt file and return its lines. Returns None if it could not be
+    retrieved, in which case everything is allowed.
+    """
     try:
-        status_code, content = fetch(robots_url)
+        status_code, content, _ = fetch(robots_url, session)
     except ALLOWED_EXCEPTIONS as e:
         logger.debug(f"Robots error: {robots_url}, {e}")
-        return True
+        return None
 
     if status_code != 200:
         logger.debug(f"Robots status code: {status_code}")
-        return True
+        return None
 
+    return decode_robots(robots_url, content)
+
+
+def decode_robots(robots_url, content: bytes) -> Optional[list[str]]:
     decoded = None
     for encoding in ['utf-8', 'iso-8859-1']:
         try:
@@ -113,60 +173,103 @@ def robots_allowed(url):
 
     if decoded is None:
         logger.info(f"Unable to decode robots file {robots_url}")
-        return True
-    
-    parse_robots.parse(decoded)
-    allowed = parse_robots.can_fetch('Mwmbl', url)
-    logger.debug(f"Robots allowed for {url}: {allowed}")
-    return allowed
+        return None
+
+    return decoded
+
+
+def add_new_links(paragraph: Paragraph, current_url, new_links: set, extra_links: set) -> bool:
+    """
+    Add the links in a classified paragraph to `new_links` if it is good, and
+    to `extra_links` otherwise. Returns True once both are full.
+    """
+    if len(paragraph.links) > 0:
+        logger.debug("Paragraph: %r", (paragraph.text, paragraph.links))
+        for link in paragraph.links:
+            url_without_hash = normalize_link(link, current_url)
+            if url_without_hash is None:
+                continue
+            if paragraph.class_type == 'good':
+                if len(new_links) < MAX_NEW_LINKS:
+                    new_links.add(url_without_hash)
+            else:
+                if len(extra_links) < MAX_EXTRA_LINKS and url_without_hash not in new_links:
+                    extra_links.add(url_without_hash)
+            if len(new_links) >= MAX_NEW_LINKS and len(extra_links) >= MAX_EXTRA_LINKS:
+                return True
+    return False
+
+
+class PageContent:
+    """
+    The extract and links of a page, collected from its classified paragraphs
+    in document order until there are enough of both.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.new_links = set()
+        self.extra_links = set()
+        self.extract = ''
+        self.links_full = False
+        self.extract_full = False
+
+    def add(self, paragraph: Paragraph) -> bool:
+        """Add the next paragraph. Returns True once later paragraphs can't change the result."""
+        if not self.links_full:
+            with timed('links'):
+                self.links_full = add_new_links(paragraph, self.url, self.new_links, self.extra_links)
+
+        if not self.extract_full and paragraph.class_type == 'good':
+            with timed('extract'):
+                self.extract += ' ' + paragraph.text.strip()
+                if len(self.extract) > NUM_EXTRACT_CHARS:
+                    self.extract = self.extract[:NUM_EXTRACT_CHARS - 1] + '…'
+                    self.extract_full = True
+
+        return self.links_full and self.extract_full
+
+
+@dataclass
+class CrawlContext:
+    """The long-lived resources shared by the crawl threads."""
+    executor: ThreadPoolExecutor
+    num_threads: int
+    sessions: SessionPool
+    robots_cache: RobotsCache
+    parser: Optional[ParserPool] = None
+    batch_stats: Optional[multiprocessing.Queue] = None
+    max_per_host: int = DEFAULT_MAX_PER_HOST
+    host_delay: float = DEFAULT_HOST_DELAY_SECONDS
+    prefetch_dns: bool = False
+    concurrency: Optional[ConcurrencyController] = None
+    timings: StageTimings = field(default_factory=StageTimings)
+
+    def __post_init__(self):
+        if self.concurrency is None:
+            self.concurrency = ConcurrencyController(self.num_threads, self.num_threads)
+
+    def parse_content(self, url, status_code, content: bytes, js_timestamp, charset: Optional[str] = None):
+        if self.parser is None:
+            return process_content(url, status_code, content, js_timestamp, charset)
+        result, times = self.parser.submit(process_content_timed, url, status_code, content, js_timestamp,
+                                           charset).result()
+        add_times(times)
+        return result
+
+
+def crawl_url(url, context: CrawlContext):
+    with profiled(), collecting() as times, context.sessions.session() as session:
+        result = _crawl_url_with_session(url, session, context)
+    context.timings.record(times)
+    return result
 
 
-def get_new_links(paragraphs: list[Paragraph], current_url):
-    new_links = set()
-    extra_links = set()
-    parsed_url = urlparse(current_url)
-    base_url = urlunsplit((parsed_url.scheme, parsed_url.netloc, "", "", ""))
-
-    for paragraph in paragraphs:
-        if len(paragraph.links) > 0:
-            logger.debug(f"Paragraph: {paragraph.text, paragraph.links}")
-            for link in paragraph.links:
-                if not link.startswith("http"):
-                    if "://" in link:
-                        logger.debug(f"Bad URL: {link}")
-                        continue
-
-                    # Relative link
-                    if link.startswith("/"):
-                        link = urljoin(base_url, link)
-                    else:
-                        link = urljoin(current_url, link)
-
-                if link.startswith('http') and len(link) <= MAX_URL_LENGTH:
-                    if BAD_URL_REGEX.search(link):
-                        logger.debug(f"Found bad URL: {link}")
-                        continue
-                    try:
-                        parsed_url = urlparse(link)
-                    except ValueError:
-                        logger.info(f"Unable to parse link {link}")
-                        continue
-                    url_without_hash = urlunsplit((parsed_url.scheme, parsed_url.netloc, parsed_url.path, parsed_url.query, ''))
-                    if paragraph.class_type == 'good':
-                        if len(new_links) < MAX_NEW_LINKS:
-                            new_links.add(url_without_hash)
-                    else:
-                        if len(extra_links) < MAX_EXTRA_LINKS and url_without_hash not in new_links:
-                            extra_links.add(url_without_hash)
-                if len(new_links) >= MAX_NEW_LINKS and len(extra_links) >= MAX_EXTRA_LINKS:
-                    return new_links, extra_links
-    return new_links, extra_links
-
-
-def crawl_url(url):
+def _crawl_url_with_session(url, session: requests.Session, context: CrawlContext):
     logger.info(f"Crawling URL {url}")
     js_timestamp = int(time.time() * 1000)
-    allowed = robots_allowed(url)
+    with timed('robots'):
+        allowed = robots_allowed(url, session, context.robots_cache)
     if not allowed:
         return {
             'url': url,
@@ -180,7 +283,7 @@ def crawl_url(url):
         }
 
     try:
-        status_code, content = fetch(url)
+        status_code, content, headers = fetch(url, session, html_only=True)
     except ALLOWED_EXCEPTIONS as e:
         logger.debug(f"Exception crawling URl {url}: {e}")
         return {
@@ -194,6 +297,14 @@ def crawl_url(url):
             }
         }
 
+    return context.parse_content(url, status_code, content, js_timestamp, get_charset(headers))
+
+
+def process_content(url, status_code, content: bytes, js_timestamp, charset: Optional[str] = None):
+    """
+    Turn a fetched page into a crawl result. This is CPU bound and does no I/O.
+    `charset` is the one given in the response's Content-Type header, if any.
+    """
     if len(content) == 0:
         return {
             'url': url,
@@ -207,7 +318,8 @@ def crawl_url(url):
         }
 
     try:
-        dom = html_to_dom(content, DEFAULT_ENCODING, None, DEFAULT_ENC_ERRORS)
+        with timed('html_to_dom'):
+            dom = html_to_dom(content, DEFAULT_ENCODING, None, DEFAULT_ENC_ERRORS, charset)
     except Exception as e:
         logger.exception(f"Error parsing dom: {url}")
         return {
@@ -221,18 +333,21 @@ def crawl_url(url):
             }
         }
         
-    title_element = dom.xpath("//title")
-    title = ""
-    if len(title_element) > 0:
-        title_text = title_element[0].text
-        if title_text is not None:
-            title = title_text.strip()
-
-    if len(title) > NUM_TITLE_CHARS:
-        title = title[:NUM_TITLE_CHARS - 1] + '…'
-
+    with timed('extract'):
+        title_element = dom.xpath("//title")
+        title = ""
+        if len(title_element) > 0:
+            title_text = title_element[0].text
+            if title_text is not None:
+                title = title_text.strip()
+
+        if len(title) > NUM_TITLE_CHARS:
+            title = title[:NUM_TITLE_CHARS - 1] + '…'
+
+    page_content = PageContent(url)
     try:
-        paragraphs = core.justext_from_dom(dom, utils.get_stoplist("English"))
+        with timed('justext'):
+            core.justext_from_dom_until(dom, utils.get_stoplist("English"), page_content.add)
     except Exception as e:
         logger.exception("Error parsing paragraphs")
         return {
@@ -246,18 +361,9 @@ def crawl_url(url):
             }
         }
 
-    new_links, extra_links = get_new_links(paragraphs, url)
-    logger.debug(f"Got new links {new_links}")
-    logger.debug(f"Got extra links {extra_links}")
-
-    extract = ''
-    for paragraph in paragraphs:
-        if paragraph.class_type != 'good':
-            continue
-        extract += ' ' + paragraph.text.strip()
-        if len(extract) > NUM_EXTRACT_CHARS:
-            extract = extract[:NUM_EXTRACT_CHARS - 1] + '…'
-            break
+    new_links, extra_links, extract = page_content.new_links, page_content.extra_links, page_content.extract
+    logger.debug("Got new links %s", new_links)
+    logger.debug("Got extra links %s", extra_links)
 
     return {
       'url': url,
@@ -273,17 +379,416 @@ def crawl_url(url):
     }
 
 
-def crawl_batch(batch, num_threads):
-    with ThreadPool(num_threads) as pool:
-        result = pool.map(crawl_url, batch)
+def process_content_timed(url, status_code, content: bytes, js_timestamp, charset: Optional[str] = None):
+    """`process_content` for another thread or process, also returning the time spent in each stage."""
+    with profiled(), collecting() as times:
+        result = process_content(url, status_code, content, js_timestamp, charset)
+    return result, times
+
+
+def get_crawl_delay(robots_cache: RobotsCache, url) -> Optional[float]:
+    """Look up the Crawl-delay for a URL's host if its robots.txt has already been fetched."""
+    try:
+        parsed_url = urlparse(url)
+    except ValueError:
+        return None
+    parse_robots = robots_cache.peek((parsed_url.scheme, parsed_url.netloc))
+    if parse_robots is None:
+        return None
+    return parse_robots.crawl_delay('Mwmbl')
+
+
+def iter_crawl_results(batch, context: CrawlContext):
+    """
+    Crawl the URLs in a batch on the executor, yielding results as they complete.
+    URLs are handed to the executor by a HostScheduler, which limits how hard
+    each host is hit. A URL that has been running for longer than
+    URL_DEADLINE_SECONDS is given up on and yields an AbortError result, so one
+    hung URL can't hold up the batch.
+    """
+    batches = iter([(None, batch)])
+    for _, result in iter_batch_results(lambda block: next(batches, None), context):
+        yield result
+
+
+def iter_batch_results(next_batch: Callable[[bool], Optional[tuple]], context: CrawlContext, max_batches: int = 1):
+    """
+    Crawl the URLs of a stream of batches as `iter_crawl_results` does, yielding
+    the key of each URL's batch with its result. `next_batch(block)` returns
+    the next batch as a tuple of a key and its URLs, or None if there isn't one
+    ready, or if `block` is set and there are no more. A new batch is taken on
+    whenever those being crawled can't fill the free slots, with up to
+    `max_batches` being crawled at once, so the slow URLs at the end of one
+    batch don't leave the executor idle.
+    """
+    start_times = {}
+    concurrency = context.concurrency
+
+    def crawl(i, url):
+        start_times[i] = time.monotonic(), int(time.time() * 1000)
+        return crawl_url(url, context)
+
+    scheduler = HostScheduler([], context.max_per_host, context.host_delay,
+                              partial(get_crawl_delay, context.robots_cache))
+    # The keys of the batches each URL waiting in the scheduler belongs to, in the order they were added
+    url_keys = {}
+    # The number of URLs not yet finished in each batch being crawled
+    remaining = {}
+    futures = {}
+    submitted = 0
+    exhausted = False
+    while True:
+        for url in scheduler.pop_ready(concurrency.limit - len(futures)):
+            keys = url_keys[url]
+            key = keys.popleft()
+            if not keys:
+                del url_keys[url]
+            futures[context.executor.submit(crawl, submitted, url)] = (submitted, url, key)
+            submitted += 1
+
+        if not exhausted and len(futures) < concurrency.limit and len(remaining) < max_batches:
+            idle = not futures and len(scheduler) == 0
+            batch = next_batch(idle)
+            if batch is not None:
+                key, urls = batch
+                remaining[key] = remaining.get(key, 0) + len(urls)
+                for url in urls:
+                    url_keys.setdefault(url, deque()).append(key)
+                scheduler.add(urls)
+                continue
+            exhausted = idle
+
+        if exhausted and not futures and len(scheduler) == 0:
+            return
+
+        timeout = get_wait_timeout(scheduler, len(futures) < concurrency.limit)
+        if not futures:
+            time.sleep(timeout)
+            continue
+
+        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+        now = time.monotonic()
+        for future in done:
+            i, url, key = futures.pop(future)
+            scheduler.release(url)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.exception(f"Error crawling URL {url}")
+                result = {
+                    'url': url,
+                    'status': None,
+                    'timestamp': int(time.time() * 1000),
+                    'content': None,
+                    'error': {
+                        'name': e.__class__.__name__,
+                        'message': str(e),
+                    }
+                }
+            concurrency.record(now - start_times.pop(i)[0], is_crawl_error(result))
+            _finish_url(remaining, key)
+            yield key, result
+
+        for future, (i, url, key) in list(futures.items()):
+            if i not in start_times:
+                continue
+            start_time, js_timestamp = start_times[i]
+            if now - start_time > URL_DEADLINE_SECONDS:
+                logger.info(f"Deadline exceeded for URL {url}")
+                del futures[future]
+                del start_times[i]
+                scheduler.release(url)
+                concurrency.record(now - start_time, True)
+                _finish_url(remaining, key)
+                yield key, {
+                    'url': url,
+                    'status': None,
+                    'timestamp': js_timestamp,
+                    'content': None,
+                    'error': {
+                        'name': 'AbortError',
+                        'message': f'Crawling took longer than {URL_DEADLINE_SECONDS} seconds',
+                    }
+                }
+
+
+def get_wait_timeout(scheduler: HostScheduler, free_slots: bool) -> float:
+    """
+    How long to wait for a URL to finish before looking again. A host becoming
+    ready only matters if there is a free slot to give it, otherwise we wait
+    for a completion, but look at least once a second for URLs past their deadline.
+    """
+    wait_time = scheduler.wait_time() if free_slots else None
+    return 1 if wait_time is None else min(wait_time, 1)
+
+
+def _finish_url(remaining: dict, key):
+    remaining[key] -= 1
+    if remaining[key] == 0:
+        del remaining[key]
+
+
+def is_crawl_error(result) -> bool:
+    """Whether crawling a URL failed, not counting URLs disallowed by robots.txt."""
+    return result['error'] is not None and result['error']['name'] != 'RobotsDenied'
+
+
+def crawl_batch(batch, context: CrawlContext):
+    return list(iter_crawl_results(batch, context))
+
+
+async def fetch_async(url, session, html_only: bool = False, chunk_size: int = FETCH_CHUNK_SIZE):
+    """The equivalent of `fetch` for an aiohttp session."""
+    with timed('first_byte'):
+        r = await session.get(url)
+    async with r:
+        with timed('download'):
+            if html_only:
+                content_type = r.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type and content_type not in HTML_CONTENT_TYPES:
+                    raise ValueError(f"Unsupported content type {content_type}")
+
+            if r.content_length is not None and r.content_length > MAX_FETCH_SIZE:
+                raise ValueError(f"Content length {r.content_length} exceeds maximum fetch size")
+
+            size = 0
+            start = time.monotonic()
+
+            chunks = []
+            async for chunk in r.content.iter_chunked(chunk_size):
+                if time.monotonic() - start > TIMEOUT_SECONDS:
+                    raise ValueError('Timeout reached')
+
+                size += len(chunk)
+                if size > MAX_FETCH_SIZE:
+                    logger.debug(f"Maximum size reached for URL {url}")
+                    chunks.append(chunk[:len(chunk) - (size - MAX_FETCH_SIZE)])
+                    break
+                chunks.append(chunk)
+
+            return r.status, b"".join(chunks), r.headers
+
+
+def get_async_exceptions():
+    import aiohttp
+    return ALLOWED_EXCEPTIONS + (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+async def fetch_robots_async(robots_url, session) -> Optional[list[str]]:
+    try:
+        status_code, content, _ = await fetch_async(robots_url, session)
+    except get_async_exceptions() as e:
+        logger.debug(f"Robots error: {robots_url}, {e}")
+        return None
+
+    if status_code != 200:
+        logger.debug(f"Robots status code: {status_code}")
+        return None
+
+    return decode_robots(robots_url, content)
+
+
+async def robots_allowed_async(url, session, robots_cache: RobotsCache):
+    try:
+        parsed_url = urlparse(url)
+    except ValueError:
+        logger.info(f"Unable to parse URL: {url}")
+        return False
+
+    if parsed_url.path.rstrip('/') == '' and parsed_url.query == '':
+        logger.debug(f"Allowing root domain for URL: {url}")
+        return True
+
+    robots_url = urlunsplit((parsed_url.scheme, parsed_url.netloc, 'robots.txt', '', ''))
+    parse_robots = await robots_cache.get_async((parsed_url.scheme, parsed_url.netloc),
+                                                partial(fetch_robots_async, robots_url, session))
+    if parse_robots is None:
+        return True
+
+    allowed = parse_robots.can_fetch('Mwmbl', url)
+    logger.debug(f"Robots allowed for {url}: {allowed}")
+    return allowed
+
+
+async def crawl_url_async(url, session, robots_cache: RobotsCache, semaphore: asyncio.Semaphore,
+                          parse_executor: ThreadPoolExecutor, parser: Optional[ParserPool]):
+    """
+    Crawl a URL on the event loop, returning a result in the same form as `crawl_url`.
+    Parsing the page is CPU bound so it is done on `parse_executor`, or in a worker
+    process if there is a parser pool.
+    """
+    async with semaphore:
+        logger.info(f"Crawling URL {url}")
+        js_timestamp = int(time.time() * 1000)
+        with timed('robots'):
+            allowed = await robots_allowed_async(url, session, robots_cache)
+        if not allowed:
+            return {
+                'url': url,
+                'status': None,
+                'timestamp': js_timestamp,
+                'content': None,
+                'error': {
+                    'name': 'RobotsDenied',
+                    'message': 'Robots do not allow this URL',
+                }
+            }
+
+        try:
+            status_code, content, headers = await fetch_async(url, session, html_only=True)
+        except get_async_exceptions() as e:
+            logger.debug(f"Exception crawling URl {url}: {e}")
+            return {
+                'url': url,
+                'status': None,
+                'timestamp': js_timestamp,
+                'content': None,
+                'error': {
+                    'name': 'AbortError',
+                    'message': str(e),
+                }
+            }
+
+    charset = get_charset(headers)
+    if parser is not None:
+        result, times = await asyncio.wrap_future(parser.submit(process_content_timed, url, status_code, content,
+                                                                js_timestamp, charset))
+    else:
+        loop = asyncio.get_running_loop()
+        result, times = await loop.run_in_executor(parse_executor, process_content_timed, url, status_code, content,
+                                                   js_timestamp, charset)
+    add_times(times)
     return result
 
 
+async def crawl_url_with_deadline_async(url, *args):
+    js_timestamp = int(time.time() * 1000)
+    try:
+        return await asyncio.wait_for(crawl_url_async(url, *args), URL_DEADLINE_SECONDS)
+    except asyncio.TimeoutError:
+        logger.info(f"Deadline exceeded for URL {url}")
+        return {
+            'url': url,
+            'status': None,
+            'timestamp': js_timestamp,
+            'content': None,
+            'error': {
+                'name': 'AbortError',
+                'message': f'Crawling took longer than {URL_DEADLINE_SECONDS} seconds',
+            }
+        }
+    except Exception as e:
+        logger.exception(f"Error crawling URL {url}")
+        return {
+            'url': url,
+            'status': None,
+            'timestamp': js_timestamp,
+            'content': None,
+            'error': {
+                'name': e.__class__.__name__,
+                'message': str(e),
+            }
+        }
+
+
+async def crawl_batch_async(scheduler: HostScheduler, concurrency: ConcurrencyController,
+                            timings: StageTimings, store_result: Callable[[dict], None], *args):
+    """
+    Crawl the URLs of a batch in the order given by the scheduler, keeping up to
+    the concurrency limit in flight. Each result is passed to `store_result` in
+    the default executor as soon as it is done.
+    """
+    loop = asyncio.get_running_loop()
+    async def crawl(url):
+        with collecting() as times:
+            result = await crawl_url_with_deadline_async(url, *args)
+        timings.record(times)
+        return result
+
+    results = []
+    tasks = {}
+    while len(scheduler) > 0 or tasks:
+        for url in scheduler.pop_ready(concurrency.limit - len(tasks)):
+            tasks[asyncio.create_task(crawl(url))] = url, time.monotonic()
+
+        timeout = get_wait_timeout(scheduler, len(tasks) < concurrency.limit)
+        if not tasks:
+            await asyncio.sleep(timeout)
+            continue
+
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        now = time.monotonic()
+        for task in done:
+            url, start_time = tasks.pop(task)
+            scheduler.release(url)
+            result = task.result()
+            concurrency.record(now - start_time, is_crawl_error(result))
+            await loop.run_in_executor(None, store_result, result)
+            results.append(result)
+    return results
+
+
+async def run_async(domain_url: str, user_id: str, concurrency: ConcurrencyController, pool_size: int,
+                    robots_cache: RobotsCache,
+                    parser: Optional[ParserPool], batch_stats: Optional[multiprocessing.Queue],
+                    max_per_host: int, host_delay: float, outbox: Outbox, timings: StageTimings):
+    """
+    Crawl continuously with up to the concurrency limit of URLs fetched at once
+    on a single event loop. Results are stored in the outbox to be sent.
+    """
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("The asyncio engine requires aiohttp, install it with the 'asyncio' extra")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency.max_limit)
+    parse_executor = ThreadPoolExecutor(thread_name_prefix='parser')
+    coordinator = new_coordinator_session()
+    connector = aiohttp.TCPConnector(limit=concurrency.max_limit, limit_per_host=pool_size, ttl_dns_cache=DNS_TTL_SECONDS)
+    timeout = aiohttp.ClientTimeout(sock_connect=TIMEOUT_SECONDS, sock_read=TIMEOUT_SECONDS)
+    # Don't keep cookies, so one URL's response can't change the requests for the URLs crawled after it
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS,
+                                     cookie_jar=aiohttp.DummyCookieJar(),
+                                     trace_configs=[aiohttp_trace_config()]) as session:
+        while True:
+            try:
+                new_batch = await loop.run_in_executor(None, get_batch, domain_url, user_id, coordinator)
+                logger.info(f"Got batch with {len(new_batch)} items")
+
+                start_time = datetime.now()
+                scheduler = HostScheduler(new_batch, max_per_host, host_delay,
+                                          partial(get_crawl_delay, robots_cache))
+                batch_id = await loop.run_in_executor(None, outbox.open_batch)
+                try:
+                    with profiled():
+                        crawl_results = await crawl_batch_async(scheduler, concurrency, timings,
+                                                                partial(outbox.add, batch_id), session, robots_cache,
+                                                                semaphore, parse_executor, parser)
+                finally:
+                    await loop.run_in_executor(None, outbox.close_batch, batch_id)
+                total_time = (datetime.now() - start_time).total_seconds()
+                logger.info(f"Crawled batch in {total_time} seconds")
+                logger.info(f"Robots cache stats: {robots_cache.pop_stats()}")
+                logger.info(f"Concurrency stats: {concurrency.pop_stats()}")
+                logger.info(f"Stage timings: {json.dumps(timings.pop_stats())}")
+                report_batch_stats(batch_stats, crawl_results)
+                end_batch()
+            except Exception:
+                logger.exception("Exception running crawl iteration")
+                await asyncio.sleep(10)
+
+
+def get_config_dir() -> Path:
+    return xdg_config_home() / 'mwmbl'
+
+
+def get_data_file(data_path: Optional[str]) -> Path:
+    return Path(data_path) if data_path is not None else get_config_dir() / 'config.json'
+
+
 def get_user_id(data_path: Optional[str]):
-    if data_path is None:
-        path = xdg_config_home() / 'mwmbl' / 'config.json'
-    else:
-        path = Path(data_path)
+    path = get_data_file(data_path)
     try:
         return json.loads(path.read_text())['user_id']
     except FileNotFoundError:
@@ -293,23 +798,36 @@ def get_user_id(data_path: Optional[str]):
         return user_id
 
 
-def send_batch(domain_url: str, batch_items, user_id):
-    batch = {
-      'user_id': user_id,
-      'items': batch_items,
-    }
-
-    logger.info("Sending batch", batch)
+def send_batch(domain_url: str, batch_items, user_id, session: requests.Session,
+               compression: str = DEFAULT_COMPRESSION, stream: bool = False):
+    body = BatchBody(user_id, batch_items, compression)
 
     post_batch_url = f"{domain_url}{POST_BATCH_URL}"
-    logger.info(f"Sending batch to {post_batch_url}")
-    response = requests.post(post_batch_url, json=batch, headers={'Content-Type': 'application/json'})
-    logger.info(f"Response status: {response.status_code}, {response.content}")
-
-
-def get_batch(domain_url: str, user_id: str):
+    start_time = time.thread_time()
+    response = session.post(post_batch_url, data=body if stream else body.encode(), headers=body.headers)
+    cpu_time = time.thread_time() - start_time
+    logger.info("Sent batch of %d items to %s: %d bytes of JSON as %d bytes %s, %.3fs CPU, "
+                "response status %d, %d bytes", len(batch_items), post_batch_url, body.raw_size, body.wire_size,
+                compression, cpu_time, response.status_code, len(response.content))
+    if response.status_code in RETRY_STATUS_CODES or response.status_code >= 500:
+        raise ValueError(f"Batch not accepted, status code {response.status_code}, content {response.content}")
+    if response.status_code >= 400:
+        raise RejectedBatch(f"Batch rejected, status code {response.status_code}, content {response.content}")
+
+
+def start_sender(domain_url: str, user_id: str, outbox: Outbox, compression: str = DEFAULT_COMPRESSION,
+                 stream: bool = False):
+    """Send the batches in the outbox from a background thread, starting with any left from a previous run."""
+    coordinator = new_coordinator_session()
+    sender = OutboxSender(outbox, partial(send_batch, domain_url, user_id=user_id, session=coordinator,
+                                          compression=compression, stream=stream))
+    sender.start()
+    return sender
+
+
+def get_batch(domain_url: str, user_id: str, session: requests.Session):
     post_new_batch_url = f"{domain_url}{POST_NEW_BATCH_URL}"
-    response = requests.post(post_new_batch_url, json={'user_id': user_id})
+    response = session.post(post_new_batch_url, json={'user_id': user_id})
     if response.status_code != 200:
         raise ValueError(f"No batch received, status code {response.status_code}, content {response.content}")
 
@@ -320,18 +838,121 @@ def get_batch(domain_url: str, user_id: str):
     return urls_to_crawl
 
 
-def run_crawl_iteration(domain_url: str, user_id, num_threads):
-    new_batch = get_batch(domain_url, user_id)
+def run_crawl_iteration(domain_url: str, user_id, context: CrawlContext, coordinator: requests.Session,
+                        outbox: Outbox):
+    new_batch = get_batch(domain_url, user_id, coordinator)
     logger.info(f"Got batch with {len(new_batch)} items")
-    crawl_and_send_batch(domain_url, new_batch, num_threads, user_id)
+    prefetch_dns(new_batch, context)
+    crawl_and_send_batch(new_batch, context, outbox)
 
 
-def crawl_and_send_batch(domain_url: str, new_batch, num_threads, user_id):
+def crawl_and_send_batch(new_batch, context: CrawlContext, outbox: Outbox):
+    """
+    Crawl a batch, storing each result in the outbox as it completes, then close
+    the batch so it is sent in the background.
+    """
     start_time = datetime.now()
-    crawl_results = crawl_batch(new_batch, num_threads)
+    batch_id = outbox.open_batch()
+    crawl_results = []
+    try:
+        for result in iter_crawl_results(new_batch, context):
+            outbox.add(batch_id, result)
+            crawl_results.append(result)
+    finally:
+        outbox.close_batch(batch_id)
+    log_batch(crawl_results, context, start_time)
+
+
+def log_batch(crawl_results, context: CrawlContext, start_time: datetime):
     total_time = (datetime.now() - start_time).total_seconds()
     logger.info(f"Crawled batch in {total_time} seconds")
-    send_batch(domain_url, crawl_results, user_id)
+    logger.info(f"Connection stats: {context.sessions.stats.snapshot()}")
+    logger.info(f"Robots cache stats: {context.robots_cache.pop_stats()}")
+    logger.info(f"Concurrency stats: {context.concurrency.pop_stats()}")
+    logger.info(f"Stage timings: {json.dumps(context.timings.pop_stats())}")
+    if context.sessions.dns_cache is not None:
+        logger.info(f"DNS cache stats: {context.sessions.dns_cache.pop_stats()}")
+    report_batch_stats(context.batch_stats, crawl_results)
+    end_batch()
+
+
+def report_batch_stats(batch_stats: Optional[multiprocessing.Queue], crawl_results):
+    """Let the supervisor know how many URLs this worker crawled."""
+    if batch_stats is None:
+        return
+    num_errors = sum(1 for result in crawl_results if result['error'] is not None)
+    batch_stats.put({'urls': len(crawl_results), 'errors': num_errors})
+
+
+def new_coordinator_session():
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    return session
+
+
+def prefetch_dns(new_batch, context: CrawlContext):
+    """Start resolving the hosts in a batch so the lookups are cached by the time we crawl."""
+    if context.prefetch_dns and context.sessions.dns_cache is not None:
+        context.sessions.dns_cache.prefetch(new_batch)
+
+
+def prefetch_batches(domain_url: str, user_id: str, batches: Queue, context: CrawlContext):
+    """
+    Keep the batch queue topped up. Blocks while the queue is full, so at most
+    `batches.maxsize` batches are fetched ahead of the crawl.
+    """
+    coordinator = new_coordinator_session()
+    while True:
+        try:
+            new_batch = get_batch(domain_url, user_id, coordinator)
+        except Exception:
+            logger.exception("Exception getting batch")
+            time.sleep(10)
+            continue
+        logger.info(f"Got batch with {len(new_batch)} items")
+        prefetch_dns(new_batch, context)
+        batches.put(new_batch)
+
+
+def run_pipelined(domain_url: str, user_id: str, context: CrawlContext, prefetch: int, outbox: Outbox):
+    """
+    Crawl continuously while the next batches are fetched by a background thread.
+    URLs from the next batch are crawled as soon as there are free threads.
+    Results are stored in the outbox as they complete, and each batch is closed
+    once all its URLs are done.
+    """
+    batches = Queue(maxsize=prefetch)
+    Thread(target=prefetch_batches, args=(domain_url, user_id, batches, context), daemon=True).start()
+
+    # The start time, number of URLs and results so far of each batch being crawled, by outbox batch ID
+    crawling = {}
+
+    def next_batch(block: bool):
+        try:
+            new_batch = batches.get(block=block)
+        except Empty:
+            return None
+        batch_id = outbox.open_batch()
+        crawling[batch_id] = datetime.now(), len(new_batch), []
+        return batch_id, new_batch
+
+    while True:
+        try:
+            for batch_id, result in iter_batch_results(next_batch, context, max_batches=prefetch + 1):
+                outbox.add(batch_id, result)
+                start_time, size, crawl_results = crawling[batch_id]
+                crawl_results.append(result)
+                if len(crawl_results) == size:
+                    del crawling[batch_id]
+                    outbox.close_batch(batch_id)
+                    log_batch(crawl_results, context, start_time)
+        except Exception:
+            logger.exception("Exception crawling batches")
+            # Send what was crawled of the unfinished batches
+            for batch_id in crawling:
+                outbox.close_batch(batch_id)
+            crawling.clear()
+            time.sleep(10)
 
 
 def run_continuously():
@@ -341,18 +962,145 @@ def run_continuously():
     argparser.add_argument("--data-path", "-p", type=str, help="Path to file for storing user data - "
                                                                "this must be unique for each process run in parallel", default=None)
     argparser.add_argument("--domain", type=str, default="https://mwmbl.org")
+    argparser.add_argument("--robots-store", type=str, nargs="?", const=str(get_config_dir() / 'robots.db'),
+                           default=None, help="Keep robots.txt files in a SQLite database shared between "
+                                              "crawler processes, optionally at the given path")
+    argparser.add_argument("--pool-size", type=int, help="Maximum number of keep-alive connections per host",
+                           default=DEFAULT_POOL_SIZE)
+    argparser.add_argument("--max-per-host", type=int, default=DEFAULT_MAX_PER_HOST,
+                           help="Maximum number of URLs to crawl from the same host at once")
+    argparser.add_argument("--host-delay", type=float, default=DEFAULT_HOST_DELAY_SECONDS,
+                           help="Minimum number of seconds between requests to the same host, or the host's "
+                                "Crawl-delay if that is longer")
+    argparser.add_argument("--prefetch-dns", action="store_true",
+                           help="Resolve the hosts in each batch in the background as soon as it is received")
+    argparser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+                           help="Crawl with a pool of threads, or with asyncio where -j sets the number of "
+                                "URLs in flight at once")
+    argparser.add_argument("--parse-processes", type=int, default=0,
+                           help="Number of processes to parse pages in, for example the number of cores. "
+                                "By default pages are parsed in the crawl threads")
+    argparser.add_argument("--prefetch", type=int, default=0,
+                           help="Number of batches to fetch ahead while crawling, with results submitted in the "
+                                "background. By default each batch is fetched, crawled and submitted in turn")
+    argparser.add_argument("--workers", type=int, default=1,
+                           help="Number of crawler processes to run and supervise, each with its own user ID "
+                                "stored next to the data path")
+    argparser.add_argument("--adaptive", action="store_true",
+                           help="Adjust the number of URLs crawled at once according to latency, errors and CPU use, "
+                                "starting from the number of threads")
+    argparser.add_argument("--min-concurrency", type=int, default=1,
+                           help="Fewest URLs to crawl at once in adaptive mode")
+    argparser.add_argument("--max-concurrency", type=int, default=None,
+                           help=f"Most URLs to crawl at once in adaptive mode, by default "
+                                f"{DEFAULT_MAX_CONCURRENCY_FACTOR} times the number of threads")
+    argparser.add_argument("--metrics-port", type=int, default=None,
+                           help="Serve histograms of the time spent in each stage of crawling in the Prometheus "
+                                "format at http://127.0.0.1:PORT/metrics. With several workers, worker i uses "
+                                "PORT + i")
+    argparser.add_argument("--profile", choices=PROFILE_MODES, nargs="?", const="sample", default=None,
+                           help="Profile the crawl threads, writing a pstats file and collapsed stacks for flame "
+                                "graphs next to the data path. 'sample' mode (the default) is cheap enough to leave "
+                                "on and writes a new profile every --profile-batches batches. 'cprofile' mode is "
+                                "exact but slow, and stops after the first profile")
+    argparser.add_argument("--profile-batches", type=int, default=DEFAULT_PROFILE_BATCHES,
+                           help="Number of batches in each profile")
+    argparser.add_argument("--profile-interval", type=float, default=DEFAULT_SAMPLE_INTERVAL_SECONDS,
+                           help="Seconds between stack samples")
+    argparser.add_argument("--batch-compression", choices=COMPRESSIONS, default=DEFAULT_COMPRESSION,
+                           help="Content encoding of the crawl results sent to the server, which must be able to "
+                                "decode it. zstd requires the zstandard package")
+    argparser.add_argument("--stream-batches", action="store_true",
+                           help="Send crawl results to the server with chunked transfer encoding as they are "
+                                "encoded, rather than with a Content-Length. The server must support chunked "
+                                "request bodies")
 
     args = argparser.parse_args()
+    if args.adaptive and not 1 <= args.min_concurrency <= (args.max_concurrency or args.min_concurrency):
+        argparser.error("--min-concurrency must be at least 1 and at most --max-concurrency")
+    if args.engine == "asyncio" and (args.prefetch > 0 or args.prefetch_dns):
+        argparser.error("--prefetch and --prefetch-dns are only supported by the threads engine")
+    if not compression_available(args.batch_compression):
+        argparser.error(f"{args.batch_compression} compression is not available, install the zstd extra")
 
     level = logging.DEBUG if args.debug else logging.INFO
-    logging.basicConfig(stream=sys.stdout, level=level)
+    log_format = '%(processName)s:%(levelname)s:%(name)s:%(message)s' if args.workers > 1 else logging.BASIC_FORMAT
+    logging.basicConfig(stream=sys.stdout, level=level, format=log_format)
+
+    if args.workers > 1:
+        Supervisor(args.workers, partial(run_worker, args)).run()
+    else:
+        run_crawler(args, args.data_path, metrics_port=args.metrics_port)
 
-    user_id = get_user_id(args.data_path)
-    domain = args.domain.rstrip('/')
 
+def get_worker_data_path(data_path: Optional[str], worker_index: int) -> str:
+    path = get_data_file(data_path)
+    return str(path.with_name(f"{path.stem}-{worker_index}{path.suffix}"))
+
+
+def get_outbox_path(data_path: Optional[str]) -> Path:
+    """The outbox of crawl results to send lives next to the user data, and belongs to the same user."""
+    path = get_data_file(data_path)
+    return path.with_name(f"{path.stem}-outbox.db")
+
+
+def get_profile_path(data_path: Optional[str]) -> Path:
+    """The prefix of the profile files, which are written next to the user data."""
+    path = get_data_file(data_path)
+    return path.with_name(f"{path.stem}-profile")
+
+
+def run_worker(args, worker_index: int, batch_stats: multiprocessing.Queue):
+    # Each worker serves its metrics on the next port along
+    metrics_port = args.metrics_port + worker_index if args.metrics_port is not None else None
+    run_crawler(args, get_worker_data_path(args.data_path, worker_index), batch_stats, metrics_port)
+
+
+def get_concurrency(args) -> ConcurrencyController:
+    """A fixed limit of -j URLs in flight, or in adaptive mode a limit that starts there."""
+    if not args.adaptive:
+        return ConcurrencyController(args.num_threads, args.num_threads)
+    max_concurrency = args.max_concurrency or max(args.num_threads * DEFAULT_MAX_CONCURRENCY_FACTOR,
+                                                  args.min_concurrency)
+    return ConcurrencyController(args.min_concurrency, max_concurrency, initial=args.num_threads)
+
+
+def run_crawler(args, data_path: Optional[str], batch_stats: Optional[multiprocessing.Queue] = None,
+                metrics_port: Optional[int] = None):
+    user_id = get_user_id(data_path)
+    domain = args.domain.rstrip('/')
+    robots_store = RobotsStore(Path(args.robots_store)) if args.robots_store is not None else None
+    robots_cache = RobotsCache(store=robots_store)
+    parser = ParserPool(args.parse_processes) if args.parse_processes > 0 else None
+    outbox = Outbox(get_outbox_path(data_path))
+    start_sender(domain, user_id, outbox, args.batch_compression, args.stream_batches)
+
+    concurrency = get_concurrency(args)
+    timings = StageTimings()
+    if metrics_port is not None:
+        serve_metrics(timings, metrics_port)
+    if args.profile is not None:
+        start_profiling(BatchProfiler(args.profile, get_profile_path(data_path), args.profile_batches,
+                                      args.profile_interval))
+
+    if args.engine == "asyncio":
+        asyncio.run(run_async(domain, user_id, concurrency, args.pool_size, robots_cache, parser,
+                              batch_stats, args.max_per_host, args.host_delay, outbox, timings))
+        return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency.max_limit, thread_name_prefix='crawler')
+    sessions = SessionPool(args.pool_size, HEADERS, DnsCache())
+    context = CrawlContext(executor, concurrency.max_limit, sessions, robots_cache, parser, batch_stats,
+                           args.max_per_host, args.host_delay, args.prefetch_dns, concurrency, timings)
+
+    if args.prefetch > 0:
+        run_pipelined(domain, user_id, context, args.prefetch, outbox)
+        return
+
+    coordinator = new_coordinator_session()
     while True:
         try:
-            run_crawl_iteration(domain, user_id, args.num_threads)
+            run_crawl_iteration(domain, user_id, context, coordinator, outbox)
         except Exception:
             logger.exception("Exception running crawl iteration")
             time.sleep(10)
@@ -0,0 +1,51 @@
+"""
+Check that adaptive concurrency only backs off when the crawl is actually
+overloaded.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+from crawler.concurrency import ConcurrencyController
+from crawler.robots import RobotsCache
+
+
+def test_flat_latency_without_errors_does_not_shrink_limit(monkeypatch):
+    def crawl_url(url, context):
+        time.sleep(0.05)
+        return {'url': url, 'status': 200, 'timestamp': 0, 'content': None, 'error': None}
+
+    monkeypatch.setattr(main, 'crawl_url', crawl_url)
+    concurrency = ConcurrencyController(1, 32, initial=8)
+    with ThreadPoolExecutor(concurrency.max_limit) as executor:
+        context = main.CrawlContext(executor, concurrency.max_limit, None, RobotsCache(), host_delay=0,
+                                    concurrency=concurrency)
+        results = main.crawl_batch([f'http://host{i}.example/' for i in range(400)], context)
+
+    stats = concurrency.pop_stats()
+    assert len(results) == 400
+    assert stats['decreases'] == 0
+    assert stats['increases'] > 0
+    assert concurrency.limit > 8
+
+
+def test_crawl_loop_overhead_is_not_counted_as_load():
+    concurrency = ConcurrencyController(1, 32, initial=8)
+    # Record a window's worth of URLs at a time, busy in this thread in between as a crawl loop might be
+    for _ in range(10):
+        deadline = time.monotonic() + 0.02
+        while time.monotonic() < deadline:
+            pass
+        for _ in range(concurrency.limit):
+            concurrency.record(0.1, False)
+    assert concurrency.pop_stats()['decreases'] == 0
+    assert concurrency.limit > 8
+
+
+def test_errors_shrink_limit():
+    concurrency = ConcurrencyController(1, 32, initial=16)
+    for _ in range(16):
+        concurrency.record(0.1, False)
+    for _ in range(17):
+        concurrency.record(0.1, True)
+    assert concurrency.limit < 16
@@ -0,0 +1,210 @@
+"""
+Check that the linear time paragraph revision gives the same classes as the
+original quadratic algorithm, on random sequences of paragraphs.
+"""
+import random
+
+import pytest
+
+from justext import core
+from justext.core import (GOOD_OR_BAD, MAX_HEADING_DISTANCE_DEFAULT, IncrementalClassifier,
+                          revise_paragraph_classification)
+
+
+NUM_SEQUENCES = 3000
+CLASSES = ('good', 'bad', 'short', 'neargood')
+HEADING_DISTANCES = (0, 10, 50, MAX_HEADING_DISTANCE_DEFAULT)
+
+
+class FakeParagraph:
+    """The attributes of a paragraph that revising its class looks at."""
+
+    def __init__(self, cf_class, heading, length, class_type=''):
+        self.cf_class = cf_class
+        self.heading = heading
+        self.text = 'x' * length
+        self.class_type = class_type
+
+    def __len__(self):
+        return len(self.text)
+
+
+def _get_neighbour(i, paragraphs, ignore_neargood, inc, boundary):
+    while i + inc != boundary:
+        i += inc
+        c = paragraphs[i].class_type
+        if c in GOOD_OR_BAD:
+            return c
+        if c == 'neargood' and not ignore_neargood:
+            return c
+    return 'bad'
+
+
+def get_prev_neighbour(i, paragraphs, ignore_neargood):
+    return _get_neighbour(i, paragraphs, ignore_neargood, -1, -1)
+
+
+def get_next_neighbour(i, paragraphs, ignore_neargood):
+    return _get_neighbour(i, paragraphs, ignore_neargood, 1, len(paragraphs))
+
+
+def reference_revise(paragraphs, max_heading_distance=MAX_HEADING_DISTANCE_DEFAULT):
+    """A copy of the original revise_paragraph_classification, which scans from every paragraph."""
+
+    # good headings
+    for i, paragraph in enumerate(paragraphs):
+        # copy classes
+        paragraph.class_type = paragraph.cf_class
+        if not (paragraph.heading and paragraph.class_type == 'short'):
+            continue
+        j = i + 1
+        distance = 0
+        while j < len(paragraphs) and distance <= max_heading_distance:
+            if paragraphs[j].class_type == 'good':
+                paragraph.class_type = 'neargood'
+                break
+            distance += len(paragraphs[j].text)
+            j += 1
+
+    # classify short
+    new_classes = {}
+    for i, paragraph in enumerate(paragraphs):
+        if paragraph.class_type != 'short':
+            continue
+        prev_neighbour = get_prev_neighbour(i, paragraphs, ignore_neargood=True)
+        next_neighbour = get_next_neighbour(i, paragraphs, ignore_neargood=True)
+        if prev_neighbour == 'good' and next_neighbour == 'good':
+            new_classes[i] = 'good'
+        elif prev_neighbour == 'bad' and next_neighbour == 'bad':
+            new_classes[i] = 'bad'
+        # it must be set(['good', 'bad'])
+        elif (prev_neighbour == 'bad' and get_prev_neighbour(i, paragraphs, ignore_neargood=False) == 'neargood') or \
+             (next_neighbour == 'bad' and get_next_neighbour(i, paragraphs, ignore_neargood=False) == 'neargood'):
+            new_classes[i] = 'good'
+        else:
+            new_classes[i] = 'bad'
+
+    for i, c in new_classes.items():
+        paragraphs[i].class_type = c
+
+    # revise neargood
+    for i, paragraph in enumerate(paragraphs):
+        if paragraph.class_type != 'neargood':
+            continue
+        prev_neighbour = get_prev_neighbour(i, paragraphs, ignore_neargood=True)
+        next_neighbour = get_next_neighbour(i, paragraphs, ignore_neargood=True)
+        if (prev_neighbour, next_neighbour) == ('bad', 'bad'):
+            paragraph.class_type = 'bad'
+        else:
+            paragraph.class_type = 'good'
+
+    # more good headings
+    for i, paragraph in enumerate(paragraphs):
+        if not (paragraph.heading and paragraph.class_type == 'bad' and paragraph.cf_class != 'bad'):
+            continue
+        j = i + 1
+        distance = 0
+        while j < len(paragraphs) and distance <= max_heading_distance:
+            if paragraphs[j].class_type == 'good':
+                paragraph.class_type = 'good'
+                break
+            distance += len(paragraphs[j].text)
+            j += 1
+
+
+def random_specs(rng, with_class_types):
+    """Random paragraphs as tuples of context-free class, heading, text length and existing class."""
+    specs = []
+    for _ in range(rng.randint(0, 30)):
+        specs.append((
+            rng.choice(CLASSES),
+            rng.random() < 0.3,
+            rng.choice((0, 1, 5, 20, 60, 150, 250)),
+            rng.choice(CLASSES + ('',)) if with_class_types else '',
+        ))
+    return specs
+
+
+def make_paragraphs(specs):
+    return [FakeParagraph(*spec) for spec in specs]
+
+
+def classes(paragraphs):
+    return [paragraph.class_type for paragraph in paragraphs]
+
+
+@pytest.mark.parametrize('max_heading_distance', HEADING_DISTANCES)
+def test_revise_matches_reference(max_heading_distance):
+    rng = random.Random(max_heading_distance)
+    for _ in range(NUM_SEQUENCES):
+        # Paragraphs may already have a class, for example from an earlier revision
+        specs = random_specs(rng, with_class_types=True)
+        expected = make_paragraphs(specs)
+        reference_revise(expected, max_heading_distance)
+        actual = make_paragraphs(specs)
+        revise_paragraph_classification(actual, max_heading_distance)
+        assert classes(actual) == classes(expected), specs
+
+        # Revising again starts from the classes left by the first revision
+        reference_revise(expected, max_heading_distance)
+        revise_paragraph_classification(actual, max_heading_distance)
+        assert classes(actual) == classes(expected), specs
+
+
+def test_revise_long_runs_of_short_paragraphs():
+    specs = [('good', False, 100, '')] + [('short', False, 10, '')] * 500 + [('bad', False, 100, '')]
+    expected = make_paragraphs(specs)
+    reference_revise(expected)
+    actual = make_paragraphs(specs)
+    revise_paragraph_classification(actual)
+    assert classes(actual) == classes(expected)
+
+
+@pytest.fixture
+def keep_cf_class(monkeypatch):
+    """Make the incremental classifier use the context-free classes the fake paragraphs were given."""
+    monkeypatch.setattr(core, 'classify_paragraph', lambda paragraph, *args: None)
+
+
+def classify_incrementally(paragraphs, max_heading_distance, stop_after=None):
+    consumed = []
+
+    def consume(paragraph):
+        consumed.append(paragraph)
+        return stop_after is not None and len(consumed) >= stop_after
+
+    classifier = IncrementalClassifier(frozenset(), consume, max_heading_distance=max_heading_distance)
+    for paragraph in paragraphs:
+        if classifier.add(paragraph):
+            break
+    if not classifier.done:
+        classifier.finish()
+    assert classifier.paragraphs == consumed
+    return consumed
+
+
+@pytest.mark.parametrize('max_heading_distance', HEADING_DISTANCES)
+def test_incremental_matches_reference(keep_cf_class, max_heading_distance):
+    rng = random.Random(max_heading_distance)
+    for _ in range(NUM_SEQUENCES):
+        specs = random_specs(rng, with_class_types=False)
+        expected = make_paragraphs(specs)
+        reference_revise(expected, max_heading_distance)
+        paragraphs = make_paragraphs(specs)
+        consumed = classify_incrementally(paragraphs, max_heading_distance)
+        assert consumed == paragraphs
+        assert classes(consumed) == classes(expected), specs
+
+
+@pytest.mark.parametrize('max_heading_distance', HEADING_DISTANCES)
+def test_incremental_stops_when_consumed(keep_cf_class, max_heading_distance):
+    rng = random.Random(max_heading_distance)
+    for _ in range(NUM_SEQUENCES):
+        specs = random_specs(rng, with_class_types=False)
+        expected = make_paragraphs(specs)
+        reference_revise(expected, max_heading_distance)
+        stop_after = rng.randint(1, len(specs) + 1)
+        paragraphs = make_paragraphs(specs)
+        consumed = classify_incrementally(paragraphs, max_heading_distance, stop_after)
+        assert consumed == paragraphs[:stop_after]
+        assert classes(consumed) == classes(expected[:stop_after]), specs
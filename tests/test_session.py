@@ -0,0 +1,47 @@
+"""
+Check that pooled sessions don't carry cookies from one request to the next.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawler.session import SessionPool
+
+
+class CookieHandler(BaseHTTPRequestHandler):
+    """Sets a cookie on every response, and echoes the cookies it was sent."""
+
+    def do_GET(self):
+        body = self.headers.get('Cookie', '').encode()
+        self.send_response(200)
+        self.send_header('Set-Cookie', 'session=abc; Path=/')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CookieHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/'
+    server.shutdown()
+    server.server_close()
+
+
+def test_set_cookie_is_not_sent_back(server_url):
+    pool = SessionPool(pool_size=1)
+    try:
+        for _ in range(3):
+            with pool.session() as session:
+                response = session.get(server_url, timeout=5)
+            assert response.status_code == 200
+            assert response.text == ''
+            assert len(session.cookies) == 0
+    finally:
+        pool.close()